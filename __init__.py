@@ -2,3 +2,4 @@ from . import controllers
 from . import models
 from . import reports
 from . import wizard
+from .hooks import pre_init_hook, post_init_hook
@@ -2,10 +2,15 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
 import json
 import logging
+import os
 import uuid
 from odoo import http, SUPERUSER_ID, registry, release
 from odoo.api import Environment
 from werkzeug.exceptions import BadRequest, NotFound
+from ..models.debug import debug_buffer
+from ..models.metrics import metrics
+from ..models.res_partner import phone_service
+from ..models.server import agent_session
 
 logger = logging.getLogger(__name__)
 
@@ -19,10 +24,25 @@ def error_response(message):
     return response
 
 
+def etag_response(etag, content):
+    """Content with its ETag, 304 when the client already has it."""
+    if http.request.httprequest.if_none_match.contains(etag):
+        response = http.request.make_response('')
+        response.status_code = 304
+    else:
+        response = http.request.make_response(content)
+    response.set_etag(etag)
+    return response
+
+
 class AsteriskPlusController(http.Controller):
 
-    def check_ip(self, db=None):
-        if db:
+    def check_ip(self, db=None, env=None):
+        if env is not None:
+            allowed_ips = env[
+                'asterisk_plus.settings'].sudo().get_param(
+                'permit_ip_addresses')
+        elif db:
             with registry(db).cursor() as cr:
                 env = Environment(cr, SUPERUSER_ID, {})
                 allowed_ips = env[
@@ -85,6 +105,47 @@ class AsteriskPlusController(http.Controller):
             else:
                 return 'Error'
 
+    @http.route('/asterisk_plus/get_caller_names', type='http', auth='none',
+                methods=['GET', 'POST'], csrf=False)
+    def get_caller_names(self, **kw):
+        """Resolve many numbers in one request and one cursor.
+        Params: numbers (comma separated), country, db.
+        Returns JSON {number: {"id": partner id, "name": name}}.
+        test:
+        curl "http://ODOO_URL/asterisk_plus/get_caller_names?db=DB&numbers=N1,N2&country=US"
+        """
+        db = kw.get('db')
+        numbers = [k.replace(' ', '') for k in kw.get('numbers', '').split(',') if k.strip()]
+        country_code = kw.get('country') or False
+        if not numbers:
+            return 'Numbers not specified'
+
+        def get_names(env):
+            checked = self.check_ip(env=env)
+            if checked is not None:
+                return checked
+            result = env['res.partner'].sudo().get_partners_by_numbers(
+                numbers, country_code)
+            logger.info('get_caller_names %s numbers country %s found: %s',
+                len(numbers), country_code, len([k for k in result.values() if k['id']]))
+            response = http.request.make_response(json.dumps(result))
+            response.headers.set('Content-Type', 'application/json')
+            return response
+
+        try:
+            if db:
+                with registry(db).cursor() as cr:
+                    return get_names(Environment(cr, SUPERUSER_ID, {}))
+            return get_names(http.request.env)
+        except Exception as e:
+            logger.exception('Error:')
+            if 'request not bound to a database' in str(e):
+                return 'db not specified'
+            elif 'database' in str(e) and 'does not exist' in str(e):
+                return 'db does not exist'
+            else:
+                return 'Error'
+
     @http.route('/asterisk_plus/get_partner_manager', type='http', auth='none')
     def get_partner_manager(self, **kw):
         db = kw.get('db')
@@ -285,12 +346,97 @@ class AsteriskPlusController(http.Controller):
         if not server.generate_sip_peers:
             return error_response('; Server has generate_sip_peers setting disabled!\n')
         try:
-            return server.get_sip_peers()
+            return etag_response(*server.get_sip_peers_conf())
         except Exception as e:
             logger.exception('Cannot generate SIP peers:')
             return error_response('; Error generating peers, check Odoo log!\n')
 
 
+    @http.route('/asterisk_plus/caller_directory', methods=['GET'], auth='public')
+    def get_caller_directory(self, since=None, **kwargs):
+        """
+        Public method protected by the server's security_token
+        Caller ID directory as tab separated "number name" lines for AstDB or
+        a local map. The first line is "# version=N full|delta", pass N as
+        since to get only the changes, an empty name means delete the number.
+        test:
+        curl -v -H "x-security-token: STOKEN" http://ODOO_URL/asterisk_plus/caller_directory?since=N
+        """
+        token = http.request.httprequest.headers.get("x-security-token")
+        if not token:
+            return error_response('# No token!\n')
+        env = http.request.env
+        server = env['asterisk_plus.server'].sudo().search(
+            [('security_token', '=', token)])
+        if not server:
+            return error_response('# Bad token!\n')
+        try:
+            since = int(since) if since else None
+        except ValueError:
+            return error_response('# Bad since version!\n')
+        try:
+            version, full, entries = env['asterisk_plus.partner_number'].sudo(
+                ).get_caller_directory(since=since)
+        except Exception:
+            logger.exception('Cannot generate caller directory:')
+            return error_response('# Error generating caller directory, check Odoo log!\n')
+        lines = ['# version={} {}'.format(version, 'full' if full else 'delta')]
+        lines.extend('{}\t{}'.format(number, ' '.join(name.split()))
+                     for number, name in entries)
+        response = http.request.make_response('\n'.join(lines) + '\n')
+        response.headers.set('Content-Type', 'text/tab-separated-values; charset=utf-8')
+        response.headers.set('X-Directory-Version', str(version))
+        return response
+
+    @http.route('/asterisk_plus/metrics', methods=['GET'], auth='public')
+    def get_metrics(self):
+        """
+        Public method protected by the server's security_token
+        Metrics of all workers of the host in Prometheus text format, gauges
+        of worker local caches have the pid label.
+        test:
+        curl -v -H "x-security-token: STOKEN" http://ODOO_URL/asterisk_plus/metrics
+        """
+        token = http.request.httprequest.headers.get("x-security-token")
+        if not token:
+            return error_response('# No token!\n')
+        env = http.request.env
+        server = env['asterisk_plus.server'].sudo().search(
+            [('security_token', '=', token)])
+        if not server:
+            return error_response('# Bad token!\n')
+        gauges = [
+            ('asterisk_plus_active_channels',
+             env['asterisk_plus.channel'].sudo().search_count([('is_active', '=', True)]), {}),
+            ('asterisk_plus_active_calls',
+             env['asterisk_plus.call'].sudo().search_count([('is_active', '=', True)]), {}),
+            ('asterisk_plus_pending_events',
+             env['asterisk_plus.pending_event'].sudo().search_count([]), {}),
+            ('asterisk_plus_outbox_jobs',
+             env['asterisk_plus.outbox'].sudo().search_count([('state', '=', 'pending')]),
+             {'state': 'pending'}),
+            ('asterisk_plus_outbox_jobs',
+             env['asterisk_plus.outbox'].sudo().search_count([('state', '=', 'failed')]),
+             {'state': 'failed'}),
+            ('asterisk_plus_agent_breaker_open', int(bool(env['asterisk_plus.server'].sudo(
+                ).search_count([('agent_state', '!=', 'closed')]))), {}),
+        ]
+        pid = {'pid': os.getpid()}
+        session_stats = agent_session.stats()
+        gauges.extend([
+            ('asterisk_plus_debug_buffer_size', len(debug_buffer.records), pid),
+            ('asterisk_plus_debug_buffer_dropped', debug_buffer.dropped, pid),
+            ('asterisk_plus_phone_cache_size', len(phone_service.cache), pid),
+            ('asterisk_plus_phone_cache_hits', phone_service.cache.hits, pid),
+            ('asterisk_plus_phone_cache_misses', phone_service.cache.misses, pid),
+            ('asterisk_plus_agent_requests', session_stats['requests'], pid),
+            ('asterisk_plus_agent_connections', session_stats['connections'], pid),
+            ('asterisk_plus_agent_sessions', session_stats['sessions'], pid),
+        ])
+        response = http.request.make_response(metrics.render(gauges))
+        response.headers.set('Content-Type', 'text/plain; version=0.0.4')
+        return response
+
     @http.route('/asterisk_plus/get_user_data_by_did', auth='public', methods=['GET'])
     def get_user_data_by_did(self, **kwargs):
         """
@@ -311,41 +457,25 @@ class AsteriskPlusController(http.Controller):
         if not did:
             return error_response('; Please provide DID\n')
 
-        server = http.request.env['asterisk_plus.server'].sudo().search(
-            [('security_token', '=', token)])
-        if not server:
+        server_id = http.request.env['asterisk_plus.server'].sudo(
+            )._get_server_id_by_token(token)
+        if not server_id:
             return error_response('; Bad token!\n')
         # Check for + and prepend if absent.
         if not did.startswith('+'):
             did = '+' + did
         # Remove spaces
         did = did.replace(' ', '')
-        dial_data = {}
-        users = http.request.env['res.users'].sudo().search(
-            [('phone_normalized', '=', did)])
-        if not users:
+        route = http.request.env['asterisk_plus.user'].sudo().get_did_route(
+            server_id, did)
+        if not route:
             logger.info('User for number "%s" not found!', did)
             return error_response('; No user for this did found')
-        elif len(users) == 1:
-            # One user
-            user = users[0]
-            dial_data["mobile"] = user.mobile_normalized or 'False'
-            dial_data["dialstring"] = "False"
-            if user.asterisk_users.channels:
-                channels = []
-                for ch in user.asterisk_users.channels:
-                    channels.append(ch.name)
-                dial_data["dialstring"] = '&'.join(channels)
-        else:
+        dial_data = {
             # More users, we don't return mobile numbers in this case.
-            dial_data["mobile"] = 'False'
-            dial_data["dialstring"] = "False"
-            channels = []
-            for user in users:
-                if user.asterisk_users.channels:
-                    for ch in user.asterisk_users.channels:
-                        channels.append(ch.name)
-            dial_data["dialstring"] = '&'.join(channels)
+            'mobile': route['mobile'] or 'False',
+            'dialstring': '&'.join(route['channels']) or 'False',
+        }
         logger.info('Dial data %s by number "%s".', dial_data, did)
         return json.dumps(dial_data)
 
@@ -398,7 +528,7 @@ class AsteriskPlusController(http.Controller):
         if not server:
             return error_response('; Bad token!\n')
         try:
-            return server.generate_voicemail_conf()
+            return etag_response(*server.get_voicemail_conf())
         except Exception as e:
             logger.exception('Cannot get voicemail.conf:')
             return error_response('; Error getting voicemail, check Odoo log!\n')
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from odoo import api, SUPERUSER_ID
+
+
+def pre_init_hook(env):
+    # Odoo < 17 passes the cursor.
+    cr = getattr(env, 'cr', env)
+    # With the columns in place the ORM does not compute normalized phones
+    # partner by partner on install, the normalization job fills them.
+    cr.execute('''ALTER TABLE res_partner
+        ADD COLUMN IF NOT EXISTS phone_normalized varchar,
+        ADD COLUMN IF NOT EXISTS mobile_normalized varchar''')
+
+
+def post_init_hook(env, registry=None):
+    # Odoo < 17 passes the cursor and the registry.
+    if registry is not None:
+        env = api.Environment(env, SUPERUSER_ID, {})
+    env['asterisk_plus.phone_normalize_chunk'].schedule()
@@ -10,6 +10,8 @@ from . import settings
 from . import user_channel
 from . import user
 from . import res_partner
+from . import phone_normalize
 from . import tag
 from . import debug
+from . import outbox
 # from . import compat # Used only to upgrade old installations.
\ No newline at end of file
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import requests
+
+#: Consecutive endpoint failures that open the circuit.
+FAILURE_THRESHOLD = 3
+#: Seconds between probes while the circuit is open.
+PROBE_INTERVAL = 15
+#: Advisory lock namespace of the Agent API prober.
+PROBE_LOCK_NAMESPACE = 7462
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+AGENT_STATES = [(CLOSED, 'Available'), (OPEN, 'Unavailable'), (HALF_OPEN, 'Probing')]
+
+
+def is_endpoint_failure(response=None, exc=None):
+    """Connection errors, timeouts and 5xx replies tell that the endpoint is
+    down, other errors come from the job itself.
+    """
+    if exc is not None:
+        return isinstance(exc, (requests.exceptions.ConnectionError,
+                                requests.exceptions.Timeout))
+    return response is not None and response.status_code >= 500
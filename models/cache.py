@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread safe worker local LRU cache with optional TTL and hit / miss counters.
+    Unlike ormcache it is not wiped by registry cache clears, so callers must
+    validate or evict entries themselves.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def items(self):
+        with self._lock:
+            return [(key, item[0]) for key, item in self._data.items()]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -98,6 +98,13 @@ class Call(models.Model):
         self.reload_calls()
         return call
 
+    @api.model
+    def get_active_call(self, uniqueid):
+        """Return the active call by Uniqueid.
+        """
+        return self.search([
+            ('is_active', '=', True), ('uniqueid', '=', uniqueid)], limit=1)
+
     def _get_name(self):
         for rec in self:
             if tools.odoo.release.version_info[0] <= 11:
@@ -402,7 +409,7 @@ class Call(models.Model):
             message.insert(2, 'ref {}'.format(self.ref.name))
         # Register call to users
         if self.direction == 'in' and self.status != 'answer' and notify_users:
-            debug(self, 'Missed call notification to users: {}'.format(notify_users))
+            debug(self, 'Missed call notification to users: %s', notify_users)
             sub_register_call(
                 self,
                 subject=self.name,
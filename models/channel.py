@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
 from datetime import datetime, timedelta
-import time
 import json
 import logging
 from odoo import models, fields, api, tools, _
 from odoo.exceptions import ValidationError
 from odoo.tools import DEFAULT_SERVER_DATETIME_FORMAT as DATETIME_FORMAT
 from .settings import debug
+from .cache import LRUCache
+from .jobs import trigger_cron
+from .metrics import metrics, timed
 
 
 logger = logging.getLogger(__name__)
 
 MAX_EXTEN_LENGTH = 5
+#: Seconds a parked event waits for its parent before it is processed anyway.
+PENDING_EVENT_TIMEOUT = 2
+#: Replays of a parked event before it is left with its error.
+PENDING_EVENT_ATTEMPTS = 3
+#: Worker local marks of recent expired event checks: dbname -> True.
+pending_expiry_checks = LRUCache(maxsize=100)
+#: Advisory lock namespace of per call locks, the key is hashtext(Linkedid).
+CALL_LOCK_NAMESPACE = 7461
 
 def convert_unixtime(ts):
     if ts:
@@ -22,6 +32,17 @@ def convert_unixtime(ts):
         # Old Agent does not send EventTime so return now.
         return fields.Datetime.now()
 
+def get_event_order(event):
+    """Sort key of an AMI event: Asterisk SequenceNumber, then event timestamp.
+    Events without both keep their original order when sorted.
+    """
+    try:
+        sequence = int(event.get('SequenceNumber') or 0)
+        timestamp = float(event.get('Timestamp') or event.get('EventTime') or 0)
+    except (TypeError, ValueError):
+        return (0, 0.0)
+    return (sequence, timestamp)
+
 # Helper model to keep channel data like call recording file path, etc...
 class ChannelData(models.Model):
     _name = 'asterisk_plus.channel_data'
@@ -43,6 +64,105 @@ class ChannelData(models.Model):
         records.unlink()
 
 
+# Reorder buffer for AMI events that came before their parent channel or call.
+class PendingEvent(models.Model):
+    _name = 'asterisk_plus.pending_event'
+    _description = 'Pending Event'
+    _order = 'id'
+
+    #: What the event is waiting for.
+    wait_for = fields.Selection([('call', 'Call'), ('channel', 'Channel'),
+                                 ('channel_data', 'Channel Data')],
+                                required=True)
+    #: Uniqueid of the awaited channel or Linkedid of the awaited call.
+    uniqueid = fields.Char(size=64, index=True, required=True)
+    model = fields.Char(required=True)
+    method = fields.Char(required=True)
+    event = fields.Text(required=True)
+    #: Failed replays, the event is kept until it is replayed.
+    attempts = fields.Integer()
+    error = fields.Text()
+
+    @api.model
+    def park(self, wait_for, uniqueid, method, event, model='asterisk_plus.channel'):
+        """Keep the event until the awaited channel or call is created.
+        """
+        debug(self, '%s %s waits for %s %s', event.get('Channel'), event.get('Event'), wait_for, uniqueid)
+        metrics.inc('asterisk_plus_pending_events_parked_total', wait_for=wait_for)
+        self.sudo().create({
+            'wait_for': wait_for,
+            'uniqueid': uniqueid,
+            'model': model,
+            'method': method,
+            'event': json.dumps(event),
+        })
+        # Do not let events wait forever for a parent that never comes.
+        if not trigger_cron(self.env, 'asterisk_plus.replay_pending_events',
+                            datetime.utcnow() + timedelta(seconds=PENDING_EVENT_TIMEOUT + 1)):
+            self.replay_expired()
+
+    @api.model
+    def check_expired(self):
+        """Process expired events at most once per timeout in the worker,
+        the cron may start later than the events expire.
+        """
+        if pending_expiry_checks.get(self.env.cr.dbname):
+            return
+        pending_expiry_checks.set(self.env.cr.dbname, True, ttl=PENDING_EVENT_TIMEOUT)
+        self.replay_expired()
+
+    @api.model
+    def replay(self, wait_for, uniqueid):
+        """Process events parked for the channel or call that has just been created.
+        """
+        pending = self.sudo().search([
+            ('wait_for', '=', wait_for), ('uniqueid', '=', uniqueid),
+            ('attempts', '<', PENDING_EVENT_ATTEMPTS)])
+        self._process(pending)
+
+    @api.model
+    def replay_expired(self, seconds=PENDING_EVENT_TIMEOUT):
+        """Process events which waited too long, called also by cron.
+        Handlers get pending_expired in context and must not park them again.
+        """
+        expire_date = datetime.utcnow() - timedelta(seconds=seconds)
+        pending = self.sudo().search([
+            ('create_date', '<=', expire_date.strftime('%Y-%m-%d %H:%M:%S')),
+            ('attempts', '<', PENDING_EVENT_ATTEMPTS)])
+        self.with_context(pending_expired=True)._process(pending)
+
+    def _process(self, pending):
+        # Replay in the order the events were generated by Asterisk.
+        pending = pending.sorted(key=lambda r: get_event_order(json.loads(r.event)))
+        channels = self.env['asterisk_plus.channel']
+        for rec in pending:
+            model, method = rec.model, rec.method
+            event = json.loads(rec.event)
+            if not channels._try_lock_call(event.get('Linkedid')):
+                # Another worker is processing this call, leave it for later.
+                continue
+            user = rec.create_uid
+            wait_for = rec.wait_for
+            metrics.inc('asterisk_plus_pending_events_replayed_total', wait_for=wait_for,
+                        expired=bool(self.env.context.get('pending_expired')))
+            if tools.odoo.release.version_info[0] < 13:
+                handler = self.env[model].sudo(user.id)
+            else:
+                handler = self.env[model].with_user(user)
+            try:
+                with self.env.cr.savepoint():
+                    # Removed before the handler not to be replayed by it again,
+                    # the rollback of a failed handler restores it.
+                    rec.unlink()
+                    res = getattr(handler.with_context(
+                        self.env.context, asterisk_plus_call_locked=True), method)(event)
+                    debug(self, 'Replayed %s %s: %s', event.get('Channel'), event.get('Event'), res)
+            except Exception as e:
+                logger.exception('Replay %s.%s error:', model, method)
+                metrics.inc('asterisk_plus_pending_events_failed_total', wait_for=wait_for)
+                rec.write({'attempts': rec.attempts + 1, 'error': str(e)})
+
+
 class Channel(models.Model):
     _name = 'asterisk_plus.channel'
     _rec_name = 'channel'
@@ -103,6 +223,8 @@ class Channel(models.Model):
     cause_txt = fields.Char(index=True)
     hangup_date = fields.Datetime(index=True)
     timestamp = fields.Char(size=20)
+    #: AMI SequenceNumber of the last processed event.
+    sequence_number = fields.Integer()
     event = fields.Char(size=64)
     #: Flag to indicate if the channel is active
     is_active = fields.Boolean(index=True)
@@ -119,11 +241,18 @@ class Channel(models.Model):
                 rec.channel_short = False
 
     def _get_parent_channel(self):
+        # One query for all records, the latest channel wins as before.
+        linkedids = set(rec.linkedid for rec in self
+                        if rec.linkedid and rec.uniqueid != rec.linkedid)
+        parents = {}
+        if linkedids:
+            for parent in self.search([('uniqueid', 'in', list(linkedids))],
+                                      order='id desc'):
+                parents.setdefault(parent.uniqueid, parent)
         for rec in self:
             if rec.uniqueid != rec.linkedid:
                 # Asterisk bound channels
-                rec.parent_channel = self.search(
-                    [('uniqueid', '=', rec.linkedid)], limit=1)
+                rec.parent_channel = parents.get(rec.linkedid, False)
             else:
                 rec.parent_channel = False
     
@@ -135,6 +264,74 @@ class Channel(models.Model):
         for rec in self:
             rec.is_active = False
 
+    @api.model
+    def get_active_channel(self, uniqueid):
+        """Return the active channel by Uniqueid.
+        """
+        return self.search([
+            ('is_active', '=', True),
+            ('uniqueid', '=', uniqueid)], limit=1) # Some buggy Asterisk may send duplicate unique ids, so limit.
+
+    @api.model
+    def _get_event_order_data(self, event):
+        """Channel values to remember the position of the event in the stream.
+        """
+        data = {}
+        if event.get('SequenceNumber'):
+            data['sequence_number'] = int(event['SequenceNumber'])
+        if event.get('Timestamp'):
+            data['timestamp'] = event['Timestamp']
+        return data
+
+    def _is_stale_event(self, event):
+        """Check if the event is older than the last one processed on the channel.
+        """
+        self.ensure_one()
+        sequence, timestamp = get_event_order(event)
+        if sequence and self.sequence_number and sequence < self.sequence_number:
+            return True
+        try:
+            if event.get('Timestamp') and self.timestamp and \
+                    timestamp < float(self.timestamp):
+                return True
+        except ValueError:
+            pass
+        return False
+
+    @api.model
+    def _lock_call(self, *linkedids):
+        """Serialize processing of the events of the same call across workers.
+        The current transaction is committed and a new READ COMMITTED one takes
+        a transaction level advisory lock per Linkedid, so after the lock is
+        granted the rows committed by the previous holder are visible.
+        Must be called before the handler writes anything.
+        Returns self with asterisk_plus_call_locked in context.
+        """
+        if self.env.context.get('asterisk_plus_call_locked'):
+            return self
+        linkedids = sorted(set(k for k in linkedids if k))
+        if not linkedids:
+            return self
+        if not self.env.context.get('no_commit'):
+            self.env.cr.commit()
+            self.env.cr.execute('SET TRANSACTION ISOLATION LEVEL READ COMMITTED')
+        # Sorted order so that batches of several calls do not deadlock.
+        for linkedid in linkedids:
+            self.env.cr.execute('SELECT pg_advisory_xact_lock(%s, hashtext(%s))',
+                                (CALL_LOCK_NAMESPACE, linkedid))
+        return self.with_context(asterisk_plus_call_locked=True)
+
+    @api.model
+    def _try_lock_call(self, linkedid):
+        """Take the call lock without waiting, used where a commit is not
+        possible. Returns False if another transaction holds the lock.
+        """
+        if not linkedid:
+            return True
+        self.env.cr.execute('SELECT pg_try_advisory_xact_lock(%s, hashtext(%s))',
+                            (CALL_LOCK_NAMESPACE, linkedid))
+        return self.env.cr.fetchone()[0]
+
     @api.model
     def reload_channels(self, data=None):
         """Reloads channels list view.
@@ -182,12 +379,12 @@ class Channel(models.Model):
             # For incoming call we take callerid to find partner.
             partner_id = channel.env['res.partner'].get_partner_by_number(
                 channel.callerid_num, country=country)['id']
-            debug(self, 'Partner %s from callerid number %s' % (partner_id, channel.callerid_num))
+            debug(self, 'Partner %s from callerid number %s', partner_id, channel.callerid_num)
         else:
             # For outgoing calls we take exten
             partner_id = channel.env['res.partner'].get_partner_by_number(
                 channel.exten, country=country)['id']
-            debug(self, 'Partner %s from exten %s' % (partner_id, channel.exten))
+            debug(self, 'Partner %s from exten %s', partner_id, channel.exten)
         # Check if auto create partners is set & create partner.
         if channel.call.direction == 'in' and not partner_id and channel.env['asterisk_plus.settings'].get_param('auto_create_partners'):
             partner_number = channel.exten if channel.call.direction == 'out' else channel.callerid_num
@@ -195,12 +392,12 @@ class Channel(models.Model):
                 'name': partner_number,
                 'phone': partner_number,
             }).id
-            debug(channel, 'Call {} auto create partner id {}'.format(channel.call.id, partner_id))
+            debug(channel, 'Call %s auto create partner id %s', channel.call.id, partner_id)
         if partner_id:
-            debug(self, 'Setting partner %s for call %s' % (partner_id, channel.call.id))
+            debug(self, 'Setting partner %s for call %s', partner_id, channel.call.id)
             channel.call.partner = partner_id
         else:
-            debug(self, 'Partner not found for call %s' % channel.call.id)
+            debug(self, 'Partner not found for call %s', channel.call.id)
 
     def update_called_user(self, channel):
         # Secondary channel belonging to a user
@@ -217,10 +414,48 @@ class Channel(models.Model):
 
     ########################### AMI Event handlers ############################
     @api.model
+    @timed
+    def on_ami_events(self, events):
+        """Batch entry point for the Agent. Events are processed in the
+        order of their SequenceNumber / Timestamp (or as passed when missing)
+        and dispatched to the handlers registered in asterisk_plus.event.
+        The whole batch is committed once, the calls of the batch are locked
+        up front.
+        Returns a list of (channel_id, message) tuples, one per event.
+        """
+        self = self._lock_call(*[event.get('Linkedid') for event in events])
+        handlers = self.env['asterisk_plus.event'].get_handlers('AMI')
+        results = [None] * len(events)
+        # Process events in the order Asterisk generated them, results
+        # are returned in the order events were passed.
+        order = sorted(range(len(events)), key=lambda i: get_event_order(events[i]))
+        for position in order:
+            event = events[position]
+            result = (None, '{} not handled'.format(event.get('Event')))
+            for handler in handlers.get(event.get('Event'), []):
+                if not handler.check_condition(event):
+                    continue
+                try:
+                    with self.env.cr.savepoint():
+                        result = getattr(
+                            self.env[handler.model].with_context(no_commit=True),
+                            handler.method)(event)
+                except Exception:
+                    logger.exception('Event %s handler %s.%s error:',
+                        event.get('Event'), handler.model, handler.method)
+                    result = (None, '{} {} error'.format(
+                        event.get('Channel'), event.get('Event')))
+            results[position] = result
+        self.env['asterisk_plus.pending_event'].check_expired()
+        return results
+
+    @api.model
+    @timed
     def on_ami_new_channel(self, event):
         """AMI NewChannel event is processed to create a new channel in Odoo.
         """
-        debug(self, json.dumps(event))
+        self = self._lock_call(event['Linkedid'])
+        debug(self, json.dumps, event)
         data = {
             'event': event['Event'],
             'server': self.env.user.asterisk_server.id,
@@ -242,37 +477,42 @@ class Channel(models.Model):
             'is_active': True,
             'event_time': convert_unixtime(event.get('EventTime')),
         }
+        data.update(self._get_event_order_data(event))
         # Match the channel to a user
         asterisk_user = self.env[
             'asterisk_plus.user_channel'].get_user_channel(
                 event['Channel'], self.env.user.asterisk_server).asterisk_user
         if asterisk_user:
             data['user'] = asterisk_user.user.id
-            debug(self, 'Found PBX user %s for channel %s' % (asterisk_user.id, event['Channel']))
+            debug(self, 'Found PBX user %s for channel %s', asterisk_user.id, event['Channel'])
         # Search for an active channel with this Uniqueid (click2call originate).
-        channel = self.env['asterisk_plus.channel'].search([
-            ('is_active', '=', True),
-            ('uniqueid', '=', event['Uniqueid'])], limit=1) # Some buggy Asterisk may send duplicate unique ids, so limit.
+        channel = self.get_active_channel(event['Uniqueid'])
+        call = self.env['asterisk_plus.call']
+        if event['Uniqueid'] != event['Linkedid']:
+            # Secondary channel, find the primary call.
+            call = call.get_active_call(event['Linkedid']) or call.search(
+                [('uniqueid', '=', event['Linkedid'])], limit=1)
+            if not call and not channel and not self.env.context.get('pending_expired'):
+                # The primary channel is not here yet, wait for its call.
+                self.env['asterisk_plus.pending_event'].park(
+                    'call', event['Linkedid'], 'on_ami_new_channel', event)
+                return (None, '{} waits for call {}'.format(
+                    event['Channel'], event['Linkedid']))
         # Create or update channel object
         if channel:
-            debug(self, 'Found channel {} to update.'.format(event['Channel']))
+            debug(self, 'Found channel %s to update.', event['Channel'])
             channel.write(data)
         else:
             channel = self.create(data)
-            debug(channel, '{} create id: {}'.format(
-                event['Channel'], channel.id
-            ))
-        # Commit changes ASAP for next Newstate events
-        self.env.cr.commit()
+            debug(channel, '%s create id: %s', event['Channel'], channel.id)
         # Define country for number formatting
         country = (channel.user.partner_id.country_id.code or
             self.env.user.partner_id.country_id.code or None
         )
-        debug(self, '{} id {} user {} country {}'.format(
-            event['Channel'], channel.mapped('id'), channel.user.id, country
-        ))        
+        debug(self, '%s id %s user %s country %s', event['Channel'], channel.mapped('id'), channel.user.id, country)        
         if channel.no_call:
             # Special case not to create a call for the channel.
+            self.env['asterisk_plus.pending_event'].replay('channel', event['Uniqueid'])
             self.reload_channels()
             return (channel.id, '{} Newchannel ACK'.format(event['Channel']))
         """
@@ -290,8 +530,7 @@ class Channel(models.Model):
         # Create a new call for the primary channel.
         if event['Uniqueid'] == event['Linkedid']:
             # Check if call already exists as originated from click2call.
-            call = self.env['asterisk_plus.call'].search(
-                [('is_active', '=', True), ('uniqueid', '=', event['Uniqueid'])], limit=1)
+            call = self.env['asterisk_plus.call'].get_active_call(event['Uniqueid'])
             if not call:
                 # Define the call direction.
                 if channel.user:
@@ -299,7 +538,7 @@ class Channel(models.Model):
                     direction = 'out'
                 elif len(channel.callerid_num) <= MAX_EXTEN_LENGTH:
                     # PBX user not mapped but makes outgoing call.
-                    debug(self, 'Direction outgoing, primary channel with len(callerid_num) <= %s' % MAX_EXTEN_LENGTH)
+                    debug(self, 'Direction outgoing, primary channel with len(callerid_num) <= %s', MAX_EXTEN_LENGTH)
                     direction = 'out'
                 else:
                     debug(self, 'Direction incoming, primary channel case 3b.')
@@ -316,66 +555,53 @@ class Channel(models.Model):
                     'status': 'progress',
                     'server': self.env.user.asterisk_server.id,
                 })
-                debug(self, '{} spawn a new call: {}'.format(
-                    event['Channel'], call.id
-                ))
+                debug(self, '%s spawn a new call: %s', event['Channel'], call.id)
             else:
-                debug(self, 'Found call %s for channel %s' % (call.id, event['Channel']))
-        # Secondary channel, find the primary call.
+                debug(self, 'Found call %s for channel %s', call.id, event['Channel'])
+        # Secondary channel, the primary call is found above.
         else:
-            call = self.env['asterisk_plus.call'].search(
-                [('uniqueid', '=', event['Linkedid'])], limit=1)
             if call:
-                debug(self, '{} belongs to call: {}'.format(
-                    event['Channel'], call.id))
+                debug(self, '%s belongs to call: %s', event['Channel'], call.id)
             else:
-                # Where is the primary channel and call!? We have to wait for it a while.
-                self.env.cr.commit()
-                for i in range(0,10):
-                    call = self.env['asterisk_plus.call'].search(
-                        [('uniqueid', '=', event['Linkedid'])], limit=1)
-                    if not call:
-                        debug(self, 'Call for {} not found, sleeping 0.1 sec'.format(event['Channel']), level='warning')
-                        self.env.cr.commit()
-                        time.sleep(.1)
-                    else:
-                        debug(self, 'Call for {} found after {} retries.'.format(event['Channel'], i))
-                        break
-                if not call:
-                    debug(self, 'Call for {} not found, creating unlinked channel.'.format(event['Channel']), level='error')
+                debug(self, 'Call for %s not found, creating unlinked channel.', event['Channel'], level='error')
                 # Fix direction                
                 if channel.user and channel.call and channel.call.direction == 'out':
                     # Case 2
                     debug(self, 'Direction change to incoming, secondary channel with PBX user.')
                     channel.call.direction = 'in'
                 elif not channel.user and channel.call and channel.call.calling_user:
-                    debug(self, 'Direction %s, not changing as calling user is set on primary channel' % channel.call.direction)
+                    debug(self, 'Direction %s, not changing as calling user is set on primary channel', channel.call.direction)
                 else:
-                    debug(self, 'Direction %s, not changing on secondary channel.' % channel.call.direction)
+                    debug(self, 'Direction %s, not changing on secondary channel.', channel.call.direction)
         channel.call = call
         # Update call partner
         self.update_call_partner(channel, country=country)
         # Update called users
         self.update_called_user(channel)
-        # Commit again ASAP.
-        self.env.cr.commit()
         # Update call reference
         if channel.is_primary and channel.call and not channel.call.ref:
             try:
                 channel.call.update_reference(country=country)
             except Exception:
                 logger.exception('Update call reference error:')
+        # Process events that came before the channel and its call.
+        pending = self.env['asterisk_plus.pending_event']
+        if channel.is_primary and channel.call:
+            pending.replay('call', event['Uniqueid'])
+        pending.replay('channel', event['Uniqueid'])
         # Reload channels
         self.reload_channels()
         return (channel.id, 'Call ID: {}'.format(channel.call.id))
 
     @api.model
+    @timed
     def on_ami_update_channel_state(self, event):
         """AMI Newstate event. Write call status and ansered time,
             create channel message and call event log records.
             Processed when channel's state changes.
         """
-        debug(self, json.dumps(event))
+        self = self._lock_call(event.get('Linkedid'))
+        debug(self, json.dumps, event)
         get = event.get
         data = {
             'server': self.env.user.asterisk_server.id,
@@ -399,45 +625,39 @@ class Channel(models.Model):
             'is_active': True,
             'event_time': convert_unixtime(event.get('EventTime')),
         }
-        for _ in range(0,10):
-            channel = self.env['asterisk_plus.channel'].search([
-                ('is_active', '=', True),
-                ('uniqueid', '=', get('Uniqueid'))], limit=1)
-            if not channel:
-                debug(self, '{} not found, sleeping 0.1 sec'.format(get('Channel')), level='warning')
-                self.env.cr.commit()
-                time.sleep(.1)
-            else:
-                break
+        data.update(self._get_event_order_data(event))
+        channel = self.get_active_channel(get('Uniqueid'))
+        if not channel and self.search_count([('uniqueid', '=', get('Uniqueid'))]):
+            # The channel is already hangup, the state change is outdated.
+            debug(self, '%s Newstate after Hangup, discard event', get('Channel'))
+            return (False, '{} Newstate after Hangup, discard event.'.format(get('Channel')))
         if not channel:
-            debug(self, '{} not found, discard event'.format(get('Channel')), level='error')
+            if not self.env.context.get('pending_expired'):
+                self.env['asterisk_plus.pending_event'].park(
+                    'channel', get('Uniqueid'), 'on_ami_update_channel_state', event)
+                return (False, '{} waits for channel'.format(get('Channel')))
+            debug(self, '%s not found, discard event', get('Channel'), level='error')
             return (False, '{} not found, discard event.'.format(get('Channel')))
-        debug(self, '{} channel id {}'.format(get('Channel'), channel.id))
+        debug(self, '%s channel id %s', get('Channel'), channel.id)
+        if channel._is_stale_event(event):
+            debug(self, '%s outdated Newstate, discard event', get('Channel'))
+            return (channel.id, '{} outdated Newstate, discard event.'.format(get('Channel')))
         # Get call ID from the linked channel if it is not set
         if not channel.no_call and not channel.call and channel.uniqueid != channel.linkedid:
-            for _ in range(0,10):
-                linked_channel = self.env['asterisk_plus.channel'].search([
-                    ('is_active', '=', True),
-                    ('uniqueid', '=', channel.linkedid)], limit=1)
-                if not linked_channel:
-                    debug(channel,
-                          '{} linked channel {} not found, sleeping 0.1 sec'.format(
-                                channel.channel, channel.linkedid),
-                                level='warning')
-                    self.env.cr.commit()
-                    time.sleep(.1)
-                else:
-                    break
-            if linked_channel:
+            linked_channel = self.get_active_channel(channel.linkedid)
+            if linked_channel.call:
                 data['call'] = linked_channel.call.id
                 debug(channel,
-                    '{} got call {} from the linked channel {}.'.format(
-                    event['Channel'], data['call'], linked_channel.channel))
+                    '%s got call %s from the linked channel %s.', event['Channel'], data['call'], linked_channel.channel)
+            elif not self.env.context.get('pending_expired'):
+                self.env['asterisk_plus.pending_event'].park(
+                    'call', channel.linkedid, 'on_ami_update_channel_state', event)
+                return (channel.id, '{} waits for call {}'.format(
+                    event['Channel'], channel.linkedid))
         channel.write(data)
         # There is no sense to go ahead if it's impossible to find the call
         if not channel.no_call and not channel.call:
-            debug(channel, '{} id {} failed to match a call'.format(
-                    event['Channel'], channel.id), level='error')
+            debug(channel, '%s id %s failed to match a call', event['Channel'], channel.id, level='error')
             return (channel.id, '{} failed to match a call'.format(event['Channel']))
         # Append an entry to call's events
         if channel.call:
@@ -452,8 +672,7 @@ class Channel(models.Model):
             # Check for callerid update on calling leg.
             if channel.call.uniqueid == channel.uniqueid and \
                     channel.call.calling_number != channel.callerid_num:
-                debug(self, 'Change callerid number from {} to {}.'.format(
-                    channel.call.calling_number, channel.callerid_num))
+                debug(self, 'Change callerid number from %s to %s.', channel.call.calling_number, channel.callerid_num)
                 call_data['calling_number'] = channel.callerid_num
             if (channel.call.uniqueid != channel.uniqueid): # 2nd leg.
                 if channel.state_desc == 'Up':
@@ -465,24 +684,28 @@ class Channel(models.Model):
                             event['Channel'], self.env.user.asterisk_server).user
                     if user:
                         call_data['answered_user'] = user.id
-            debug(channel,'Call {} update: {}'.format(channel.call.id, call_data))
+            debug(channel, 'Call %s update: %s', channel.call.id, call_data)
             channel.call.write(call_data)
         return (channel.id, '{} Newstate ACK'.format(event['Channel']))
 
     @api.model
+    @timed
     def on_ami_hangup(self, event):
         """AMI Hangup event.
         Returns tuple (channel.id, message)
         """
-        debug(self, json.dumps(event))
-        channel = self.env['asterisk_plus.channel'].search([
-            ('is_active', '=', True),
-            ('uniqueid', '=', event['Uniqueid'])], limit=1)
+        self = self._lock_call(event['Linkedid'])
+        debug(self, json.dumps, event)
+        channel = self.get_active_channel(event['Uniqueid'])
         if not channel:
-            debug(self, 'Channel {} not found for hangup.'.format(event['Channel']))
+            if not self.env.context.get('pending_expired'):
+                self.env['asterisk_plus.pending_event'].park(
+                    'channel', event['Uniqueid'], 'on_ami_hangup', event)
+                return (None, '{} Hangup: waits for channel'.format(event['Channel']))
+            debug(self, 'Channel %s not found for hangup.', event['Channel'])
             logger.warning('Channel {} not found for hangup.'.format(event['Channel']))
             return (None, '{} Hangup: not found'.format(event['Channel']))
-        debug(self, 'Found {} channel(s) {}'.format(len(channel), event['Channel']))
+        debug(self, 'Found %s channel(s) %s', len(channel), event['Channel'])
         data = {
             'event': event['Event'],
             'channel': event['Channel'],
@@ -505,6 +728,7 @@ class Channel(models.Model):
             'is_active': False,
             'event_time': convert_unixtime(event.get('EventTime')),
         }
+        data.update(self._get_event_order_data(event))
         channel.write(data)
         if channel.no_call:
             # No need to go futher to update call data.
@@ -518,8 +742,7 @@ class Channel(models.Model):
             }
             # Check if callerid was changed on calling leg.
             if channel.call and channel.call.calling_number != channel.callerid_num:
-                debug(self, 'Change callerid number from {} to {}.'.format(
-                    channel.call.calling_number, channel.callerid_num))
+                debug(self, 'Change callerid number from %s to %s.', channel.call.calling_number, channel.callerid_num)
                 call_data['calling_number'] = channel.callerid_num
             if channel.call.status != 'answered':
                 if channel.cause == '17':
@@ -534,8 +757,7 @@ class Channel(models.Model):
                     call_data['status'] = 'ended'
                 else:
                     call_data['status'] = 'failed'
-            debug(self, 'Call {} update: {}'.format(
-                channel.call.id, call_data))
+            debug(self, 'Call %s update: %s', channel.call.id, call_data)
             channel.call.write(call_data)
         # Create hangup event        
         if channel.call:
@@ -543,11 +765,10 @@ class Channel(models.Model):
                 'call': channel.call.id,
                 'event': 'Channel {} hangup'.format(channel.channel_short),
             })
-        # Commit changes before trying to get recording
-        self.env.cr.commit()
         self.reload_channels()
         # Check if call recording is enabled and save record
         if self.env['asterisk_plus.settings'].sudo().get_param('record_calls'):
+            # Sent from the outbox after commit, so the Agent upload sees the hangup.
             self.env['asterisk_plus.recording'].save_call_recording(channel)
         return (channel.id, '{} Hangup ACK'.format(event['Channel']))
 
@@ -560,11 +781,9 @@ class Channel(models.Model):
         if event['Response'] != 'Failure':
             logger.debug(self, 'Response', 'Ignoring OriginateResponse: %s', event)
             return False
-        channel = self.env['asterisk_plus.channel'].search([
-            ('is_active', '=', True),
-            ('uniqueid', '=', event['Uniqueid'])], limit=1)
+        channel = self.get_active_channel(event['Uniqueid'])
         if not channel:
-            debug(self, 'Channel {} not found for OriginateResponse!'.format(event['Channel']))
+            debug(self, 'Channel %s not found for OriginateResponse!', event['Channel'])
             return False
         if channel.cause:
             # This is a response after Hangup so no need for it.
@@ -589,11 +808,13 @@ class Channel(models.Model):
     def update_recording_filename(self, event):
         """AMI VarSet event.
         """
-        debug(self, json.dumps(event))
+        debug(self, json.dumps, event)
         if event.get('Variable') == 'MIXMONITOR_FILENAME':
+            self = self._lock_call(event.get('Linkedid'))
             file_path = event['Value']
             uniqueid = event['Uniqueid']
-            channel = self.search([('uniqueid', '=', uniqueid)], limit=1)
+            channel = self.get_active_channel(uniqueid) or self.search(
+                [('uniqueid', '=', uniqueid)], limit=1)
             if channel:
                 self.env['asterisk_plus.channel_data'].create({
                     'channel': channel.id,
@@ -601,6 +822,9 @@ class Channel(models.Model):
                     'value': file_path,
                 })
                 return True
+            elif not self.env.context.get('pending_expired'):
+                self.env['asterisk_plus.pending_event'].park(
+                    'channel', uniqueid, 'update_recording_filename', event)
             else:
                 logger.warning('Channel %s not found to update recording!', uniqueid)
         return False
@@ -1,5 +1,88 @@
+from collections import deque
 from datetime import datetime, timedelta
+import atexit
+import logging
+import threading
 from odoo import models, fields, api, _
+from odoo.modules.registry import Registry
+from .jobs import WorkerThread
+
+logger = logging.getLogger(__name__)
+
+#: Max debug records kept in memory per worker, the oldest are dropped.
+BUFFER_SIZE = 10000
+#: Number of buffered records that triggers a flush before the timer.
+FLUSH_SIZE = 500
+#: Seconds between flushes.
+FLUSH_INTERVAL = 5
+#: Rows per INSERT statement.
+INSERT_CHUNK = 1000
+
+
+class DebugBuffer(object):
+    """Worker local ring buffer of debug records.
+    Records are written by a background thread in bulk inserts with their
+    own cursor, so the handler transaction never waits for them.
+    """
+
+    def __init__(self, maxlen=BUFFER_SIZE, flush_size=FLUSH_SIZE,
+                 interval=FLUSH_INTERVAL):
+        self.records = deque(maxlen=maxlen)
+        self.flush_size = flush_size
+        self.interval = interval
+        #: Records dropped on overflow since the worker start.
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._writer = WorkerThread(self._run, 'asterisk_plus.debug_writer')
+
+    def append(self, dbname, uid, model, message):
+        with self._lock:
+            if len(self.records) == self.records.maxlen:
+                self.dropped += 1
+            self.records.append(
+                (dbname, uid, model, message, datetime.utcnow()))
+            size = len(self.records)
+        self._writer.ensure()
+        if size >= self.flush_size:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Debug records flush error:')
+
+    def flush(self):
+        with self._lock:
+            records = list(self.records)
+            self.records.clear()
+            dropped = self.dropped - self._reported_dropped
+            self._reported_dropped = self.dropped
+        if dropped:
+            logger.warning('%s debug records dropped on buffer overflow.', dropped)
+        by_db = {}
+        for dbname, uid, model, message, date in records:
+            by_db.setdefault(dbname, []).append(
+                (model, message, uid, uid, date, date))
+        for dbname, rows in by_db.items():
+            with Registry(dbname).cursor() as cr:
+                for i in range(0, len(rows), INSERT_CHUNK):
+                    chunk = rows[i:i + INSERT_CHUNK]
+                    cr.execute(
+                        'INSERT INTO asterisk_plus_debug '
+                        '(model, message, create_uid, write_uid, create_date, write_date) '
+                        'VALUES ' + ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(chunk)),
+                        [value for row in chunk for value in row])
+
+
+debug_buffer = DebugBuffer()
+# Do not lose the last records when a worker is recycled.
+atexit.register(debug_buffer.flush)
 
 
 class Debug(models.Model):
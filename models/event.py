@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import logging
 from odoo import models, fields, api, _
+from odoo.tools.safe_eval import safe_eval
+
+logger = logging.getLogger(__name__)
 
 
 class Event(models.Model):
@@ -38,6 +42,28 @@ class Event(models.Model):
             else:
                 rec.icon = '<span class="fa fa-lock"></span>'
 
+    def check_condition(self, event):
+        """Evaluate the handler condition against the event.
+        """
+        self.ensure_one()
+        if not self.condition:
+            return True
+        try:
+            return bool(safe_eval(self.condition, {'event': event}))
+        except Exception:
+            logger.exception('Event %s condition error:', self.id)
+            return False
+
+    @api.model
+    def get_handlers(self, source='AMI'):
+        """Return enabled handlers grouped by event name in the order of creation.
+        """
+        handlers = {}
+        for rec in self.search([('source', '=', source),
+                                ('is_enabled', '=', True)], order='id'):
+            handlers.setdefault(rec.name, []).append(rec)
+        return handlers
+
     def write(self, vals):
         # Prevent record update if update = 'no'. If statement hack to allow overwrite update value
         for rec in self:
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import os
+import threading
+from odoo import tools
+
+#: Seconds a cron run works before it leaves the rest to the next run.
+RUN_TIME_LIMIT = 240
+
+
+def trigger_cron(env, xml_id, at=None):
+    """Run the cron as soon as possible or at the given UTC datetime.
+    Returns False on versions before 14, they rely on the cron interval.
+    """
+    cron = env.ref(xml_id, raise_if_not_found=False)
+    if not cron or tools.odoo.release.version_info[0] < 14:
+        return False
+    cron.sudo()._trigger(at)
+    return True
+
+
+class WorkerThread(object):
+    """Background daemon thread of the current worker process.
+    Threads do not survive the fork of prefork workers, so it is started
+    again in every process that uses it.
+    """
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure(self):
+        """Start the thread if it does not run in this process.
+        Returns True when it is started in a new process.
+        """
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            return False
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return False
+            forked = self._pid != os.getpid()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self.target, name=self.name, daemon=True)
+            self._thread.start()
+            return forked
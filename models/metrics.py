@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import atexit
+import fcntl
+import functools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from odoo.tools import config
+from .jobs import WorkerThread
+
+logger = logging.getLogger(__name__)
+
+#: Latency histogram buckets in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+#: Seconds between writes of the worker values to the metrics directory.
+FLUSH_INTERVAL = 5
+#: Values of finished workers, counters must not go back when they exit.
+ARCHIVE_FILE = 'archive.json'
+
+
+class Metrics(object):
+    """Counters and histograms rendered in Prometheus text format.
+    Every worker writes its values to a file in the metrics directory, a
+    scrape served by any worker sums the files of all workers of the host.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, interval=FLUSH_INTERVAL):
+        self.buckets = buckets
+        self.interval = interval
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._writer = WorkerThread(self._run, 'asterisk_plus.metrics_writer')
+        self._pid = None
+        self._file = None
+
+    @property
+    def path(self):
+        return os.path.join(config['data_dir'], 'asterisk_plus_metrics')
+
+    def inc(self, name, value=1, **labels):
+        self._ensure_thread()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        self._ensure_thread()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                # Bucket counts, sum, count.
+                hist = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def _ensure_thread(self):
+        if not self._writer.ensure():
+            return
+        with self._lock:
+            # Values of the parent are in its own file.
+            self.counters.clear()
+            self.histograms.clear()
+            # The start time keeps the file apart when the pid is reused.
+            self._file = '{}-{}-{}.json'.format(
+                socket.gethostname(), os.getpid(), int(time.time() * 1000))
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Metrics flush error:')
+
+    def flush(self):
+        """Write the worker values to its file in the metrics directory."""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            data = {
+                'counters': [[name, labels, value]
+                             for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, list(hist[0]), hist[1], hist[2]]
+                               for (name, labels), hist in self.histograms.items()],
+            }
+        self._write(self._file, data)
+
+    def _write(self, file_name, data):
+        os.makedirs(self.path, exist_ok=True)
+        file_path = os.path.join(self.path, file_name)
+        with open(file_path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(file_path + '.tmp', file_path)
+
+    def _read(self, file_name):
+        try:
+            with open(os.path.join(self.path, file_name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _merge(self, counters, histograms, data):
+        for name, labels, value in data.get('counters', []):
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, total, count in data.get('histograms', []):
+            key = (name, tuple(tuple(label) for label in labels))
+            hist = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            hist[0] = [a + b for a, b in zip(hist[0], buckets)]
+            hist[1] += total
+            hist[2] += count
+
+    def _is_dead_worker(self, file_name):
+        # Files are named host-pid-start.json, the host may have dashes.
+        host, pid, _start = file_name[:-len('.json')].rsplit('-', 2)
+        if host != socket.gethostname():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except (ValueError, OSError):
+            pass
+        return False
+
+    def collect(self):
+        """Sum of the values of all workers of the host. Values of exited
+        workers are moved to the archive file.
+        Returns:
+            (counters, histograms) dicts keyed by (name, labels).
+        """
+        self._ensure_thread()
+        self.flush()
+        # Scrapes must not see a file both archived and not removed yet.
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archived_counters, archived_histograms = {}, {}
+            self._merge(archived_counters, archived_histograms, self._read(ARCHIVE_FILE))
+            live, dead = [], []
+            for file_name in os.listdir(self.path):
+                if not file_name.endswith('.json') or file_name == ARCHIVE_FILE:
+                    continue
+                data = self._read(file_name)
+                if self._is_dead_worker(file_name):
+                    dead.append(file_name)
+                    self._merge(archived_counters, archived_histograms, data)
+                else:
+                    live.append(data)
+            if dead:
+                self._write(ARCHIVE_FILE, {
+                    'counters': [[name, labels, value]
+                                 for (name, labels), value in archived_counters.items()],
+                    'histograms': [[name, labels, hist[0], hist[1], hist[2]]
+                                   for (name, labels), hist in archived_histograms.items()],
+                })
+                for file_name in dead:
+                    os.remove(os.path.join(self.path, file_name))
+        counters, histograms = archived_counters, archived_histograms
+        for data in live:
+            self._merge(counters, histograms, data)
+        return counters, histograms
+
+    def render(self, gauges=None):
+        """Text exposition of all metrics. gauges is a list of
+        (name, value, labels dict) measured by the caller.
+        """
+
+        def fmt(labels):
+            if not labels:
+                return ''
+            return '{%s}' % ','.join(
+                '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in labels)
+
+        counters, histograms = self.collect()
+        lines = []
+        seen = set()
+        for name, value, labels in gauges or []:
+            if name not in seen:
+                lines.append('# TYPE %s gauge' % name)
+                seen.add(name)
+            lines.append('%s%s %s' % (name, fmt(sorted(labels.items())), value))
+        for (name, labels), value in sorted(counters.items()):
+            if name not in seen:
+                lines.append('# TYPE %s counter' % name)
+                seen.add(name)
+            lines.append('%s%s %s' % (name, fmt(labels), value))
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            if name not in seen:
+                lines.append('# TYPE %s histogram' % name)
+                seen.add(name)
+            for bound, bucket_count in zip(self.buckets, buckets):
+                lines.append('%s_bucket%s %s' % (
+                    name, fmt(labels + (('le', bound),)), bucket_count))
+            lines.append('%s_bucket%s %s' % (name, fmt(labels + (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %s' % (name, fmt(labels), total))
+            lines.append('%s_count%s %s' % (name, fmt(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+# Keep the last values when a worker is recycled.
+atexit.register(metrics.flush)
+
+
+def timed(fun):
+    """Count calls, errors and latency of a handler.
+    Put it under @api.model so that Odoo still sees the method decorator.
+    """
+    @functools.wraps(fun)
+    def wrapper(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            return fun(*args, **kwargs)
+        except Exception:
+            metrics.inc('asterisk_plus_handler_errors_total', handler=fun.__name__)
+            raise
+        finally:
+            metrics.inc('asterisk_plus_handler_calls_total', handler=fun.__name__)
+            metrics.observe('asterisk_plus_handler_duration_seconds',
+                            time.monotonic() - start, handler=fun.__name__)
+    return wrapper
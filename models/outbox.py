@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import logging
+import time
+import requests
+from odoo import models, fields, api
+from .jobs import RUN_TIME_LIMIT, trigger_cron
+from .metrics import metrics
+from .breaker import is_endpoint_failure, PROBE_INTERVAL, CLOSED
+
+logger = logging.getLogger(__name__)
+
+#: Jobs claimed per dispatcher batch.
+BATCH_SIZE = 50
+#: Concurrent requests to the Agent API.
+MAX_WORKERS = 8
+#: Attempts before a job is marked failed.
+MAX_ATTEMPTS = 8
+#: Retry delays in seconds: BACKOFF_BASE * 2 ** attempt, at most BACKOFF_MAX.
+BACKOFF_BASE = 5
+BACKOFF_MAX = 600
+#: Days failed jobs are kept.
+FAILED_KEEP_DAYS = 7
+#: Jobs safe to send again when the Agent may have got them already.
+IDEMPOTENT_FUNS = {'recording.get_file', 'file.delete'}
+
+
+class Outbox(models.Model):
+    """Agent jobs stored in the caller transaction and sent after commit.
+    The dispatcher claims jobs with SKIP LOCKED and sends them concurrently,
+    requests failed on the transport or with 5xx are retried with exponential
+    backoff, rejected ones fail at once.
+    """
+    _name = 'asterisk_plus.outbox'
+    _description = 'Agent Job Outbox'
+    _order = 'id'
+
+    server = fields.Many2one('asterisk_plus.server', required=True,
+                             ondelete='cascade')
+    fun = fields.Char(required=True)
+    args = fields.Text()
+    kwargs = fields.Text()
+    timeout = fields.Integer(default=6)
+    res_model = fields.Char()
+    res_method = fields.Char()
+    res_notify_uid = fields.Integer()
+    res_notify_title = fields.Char()
+    pass_back = fields.Text()
+    state = fields.Selection([('pending', 'Pending'), ('failed', 'Failed')],
+                             default='pending', required=True, index=True)
+    attempts = fields.Integer()
+    next_attempt = fields.Datetime(default=fields.Datetime.now, index=True)
+    error = fields.Text()
+
+    @api.model
+    def enqueue(self, server, fun, args=None, kwargs={}, timeout=6,
+                res_model=None, res_method=None, res_notify_uid=None,
+                res_notify_title='PBX', pass_back=None):
+        """Store an Agent job, it is sent when the transaction is committed.
+        """
+        job = self.create({
+            'server': server.id,
+            'fun': fun,
+            'args': json.dumps(args),
+            'kwargs': json.dumps(kwargs),
+            'timeout': timeout,
+            'res_model': res_model,
+            'res_method': res_method,
+            'res_notify_uid': res_notify_uid,
+            'res_notify_title': res_notify_title,
+            'pass_back': json.dumps(pass_back),
+        })
+        self._trigger_cron()
+        return job
+
+    @api.model
+    def _trigger_cron(self, at=None):
+        trigger_cron(self.env, 'asterisk_plus.dispatch_outbox', at)
+
+    @api.model
+    def dispatch(self, time_limit=RUN_TIME_LIMIT):
+        """Send due jobs, called by cron.
+        Safe to be called by several processes at once.
+        """
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            while time.monotonic() - started < time_limit:
+                # Jobs of servers with an open circuit keep their attempts
+                # for when the Agent API is back.
+                self.env.cr.execute("""
+                    SELECT o.id FROM asterisk_plus_outbox o
+                    JOIN asterisk_plus_server s ON s.id = o.server
+                    WHERE o.state = 'pending' AND s.agent_state = %s
+                        AND o.next_attempt <= (now() at time zone 'UTC')
+                    ORDER BY o.id LIMIT %s
+                    FOR UPDATE OF o SKIP LOCKED""", (CLOSED, BATCH_SIZE,))
+                jobs = self.browse([row[0] for row in self.env.cr.fetchall()])
+                if not jobs:
+                    break
+                jobs._send(executor)
+                self.env.cr.commit()
+            else:
+                # Time is over, continue in the next run.
+                self._trigger_cron()
+        if self.search_count([('state', '=', 'pending'), ('server.agent_state', '!=', CLOSED)]):
+            self._trigger_cron(datetime.utcnow() + timedelta(seconds=PROBE_INTERVAL))
+        self._vacuum_failed()
+
+    def _send(self, executor):
+        futures = []
+        for job in self:
+            try:
+                session, url, data = job.server._get_agent_request(
+                    job.fun, args=json.loads(job.args or 'null'),
+                    kwargs=json.loads(job.kwargs or '{}'),
+                    # Empty columns are read as 0 and False, the Agent expects None.
+                    res_model=job.res_model or None,
+                    res_method=job.res_method or None,
+                    res_notify_uid=job.res_notify_uid or None,
+                    res_notify_title=job.res_notify_title or None,
+                    pass_back=json.loads(job.pass_back or 'null'))
+                futures.append((job, executor.submit(
+                    session.post, url, json=data, timeout=job.timeout)))
+            except Exception as e:
+                job._fail(str(e))
+        sent = []
+        failures = {}
+        for job, future in futures:
+            try:
+                response = future.result()
+            except Exception as e:
+                if not is_endpoint_failure(exc=e):
+                    job._fail(str(e))
+                    continue
+                failures[job.server] = failures.get(job.server, 0) + 1
+                if isinstance(e, requests.exceptions.ReadTimeout) and \
+                        job.fun not in IDEMPOTENT_FUNS:
+                    # The Agent may run it already, sending it again can
+                    # duplicate the action.
+                    job._fail(str(e))
+                else:
+                    job._retry(str(e))
+                continue
+            failures.setdefault(job.server, 0)
+            if response.ok:
+                sent.append(job.id)
+            elif is_endpoint_failure(response=response):
+                failures[job.server] += 1
+                job._retry('{} {}'.format(response.status_code, response.text))
+            else:
+                # Rejected by the Agent, it is the same next time.
+                job._fail('{} {}'.format(response.status_code, response.text))
+        if sent:
+            metrics.inc('asterisk_plus_outbox_sent_total', len(sent))
+            self.browse(sent).unlink()
+        for server, count in failures.items():
+            server._record_agent_result(failures=count)
+
+    def _retry(self, error):
+        self.ensure_one()
+        attempts = self.attempts + 1
+        if attempts >= MAX_ATTEMPTS:
+            self._fail(error)
+            return
+        metrics.inc('asterisk_plus_local_job_errors_total', fun=self.fun)
+        next_attempt = datetime.utcnow() + timedelta(
+            seconds=min(BACKOFF_BASE * 2 ** self.attempts, BACKOFF_MAX))
+        logger.warning('Agent job %s %s error, retry at %s: %s',
+                       self.id, self.fun, next_attempt, error)
+        self.write({'attempts': attempts, 'next_attempt': next_attempt,
+                    'error': error})
+        self._trigger_cron(next_attempt)
+
+    def _fail(self, error):
+        self.ensure_one()
+        metrics.inc('asterisk_plus_local_job_errors_total', fun=self.fun)
+        metrics.inc('asterisk_plus_outbox_failed_total')
+        attempts = self.attempts + 1
+        logger.error('Agent job %s %s failed after %s attempts: %s',
+                     self.id, self.fun, attempts, error)
+        self.write({'state': 'failed', 'attempts': attempts, 'error': error})
+
+    @api.model
+    def _vacuum_failed(self, days=FAILED_KEEP_DAYS):
+        expire_date = datetime.utcnow() - timedelta(days=days)
+        self.search([('state', '=', 'failed'),
+                     ('write_date', '<', expire_date)]).unlink()
+
+    def retry_failed(self):
+        """Send failed jobs again."""
+        self.filtered(lambda r: r.state == 'failed').write({
+            'state': 'pending', 'attempts': 0, 'error': False,
+            'next_attempt': fields.Datetime.now()})
+        self._trigger_cron()
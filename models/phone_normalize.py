@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import logging
+import time
+from odoo import models, fields, api, tools
+from .jobs import RUN_TIME_LIMIT, trigger_cron
+from .res_partner import normalize_phone
+
+logger = logging.getLogger(__name__)
+
+#: Partner ids per chunk.
+CHUNK_SIZE = 5000
+#: Rows per UPDATE statement.
+UPDATE_SIZE = 1000
+#: Crons running the job in parallel.
+CRONS = ('asterisk_plus.normalize_partner_phones',
+         'asterisk_plus.normalize_partner_phones_2',
+         'asterisk_plus.normalize_partner_phones_3',
+         'asterisk_plus.normalize_partner_phones_4')
+
+
+class PhoneNormalizeChunk(models.Model):
+    """Range of partner ids to normalize phone numbers for.
+    Chunks are claimed with SKIP LOCKED and committed one by one, so the job
+    can run in several processes at once and resumes after interruption.
+    """
+    _name = 'asterisk_plus.phone_normalize_chunk'
+    _description = 'Phone Normalization Chunk'
+    _order = 'id'
+
+    start_id = fields.Integer(required=True)
+    end_id = fields.Integer(required=True)
+    state = fields.Selection([('pending', 'Pending'), ('done', 'Done'),
+                              ('failed', 'Failed')],
+                             default='pending', required=True, index=True)
+    #: Changes of the chunk are published, see _finish.
+    published = fields.Boolean()
+    processed = fields.Integer()
+    error = fields.Text()
+
+    @api.model
+    def schedule(self, chunk_size=CHUNK_SIZE):
+        """Split all partners into chunks and start the job.
+        """
+        self.search([]).unlink()
+        self.env.cr.execute('SELECT min(id), max(id) FROM res_partner')
+        min_id, max_id = self.env.cr.fetchone()
+        if min_id is None:
+            return
+        self.create([{
+            'start_id': start,
+            'end_id': min(start + chunk_size - 1, max_id),
+        } for start in range(min_id, max_id + 1, chunk_size)])
+        self._trigger_cron()
+
+    @api.model
+    def _trigger_cron(self):
+        for xml_id in CRONS:
+            trigger_cron(self.env, xml_id)
+
+    @api.model
+    def run(self, time_limit=RUN_TIME_LIMIT):
+        """Process pending chunks, called by cron.
+        Safe to be called by several processes at once.
+        """
+        started = time.monotonic()
+        default_country = self.env.user.company_id.country_id.code or None
+        while time.monotonic() - started < time_limit:
+            self.env.cr.execute("""
+                SELECT id FROM asterisk_plus_phone_normalize_chunk
+                WHERE state = 'pending' ORDER BY id LIMIT 1
+                FOR UPDATE SKIP LOCKED""")
+            row = self.env.cr.fetchone()
+            if not row:
+                break
+            chunk = self.browse(row[0])
+            try:
+                with self.env.cr.savepoint():
+                    processed = chunk._normalize(default_country)
+                chunk.write({'state': 'done', 'processed': processed,
+                             'published': False})
+            except Exception as e:
+                logger.exception('Phone normalization of partners %s-%s error:',
+                                 chunk.start_id, chunk.end_id)
+                chunk.write({'state': 'failed', 'error': str(e)})
+            self.env.cr.commit()
+        else:
+            # Time is over, continue in the next run.
+            self._trigger_cron()
+        # Also when the last chunk was done by a run that timed out.
+        self._finish()
+
+    @api.model
+    def _finish(self):
+        """Publish the changes of the job at once when no chunk is pending,
+        chunks do not log them. Unknown numbers are forgotten and the caller
+        directory is exported in full again.
+        """
+        if self.search_count([('state', '=', 'pending')]):
+            return
+        # Runs finishing at once must not publish twice.
+        self.env.cr.execute("""
+            SELECT id FROM asterisk_plus_phone_normalize_chunk
+            WHERE state = 'done' AND NOT COALESCE(published, false)
+            FOR UPDATE SKIP LOCKED""")
+        chunks = self.browse([row[0] for row in self.env.cr.fetchall()])
+        if not chunks:
+            return
+        self.env['res.partner']._evict_unknown_numbers()
+        self.env['asterisk_plus.partner_number'].reset_caller_directory()
+        chunks.write({'published': True})
+
+    def _normalize(self, default_country):
+        self.ensure_one()
+        cr = self.env.cr
+        # Country the same way as Partner._get_country.
+        cr.execute("""
+            SELECT p.id, p.phone, p.mobile,
+                   COALESCE(c.code, parent_c.code, company_c.code)
+            FROM res_partner p
+            LEFT JOIN res_country c ON c.id = p.country_id
+            LEFT JOIN res_partner parent ON parent.id = p.parent_id
+            LEFT JOIN res_country parent_c ON parent_c.id = parent.country_id
+            LEFT JOIN res_company company ON company.id = p.company_id
+            LEFT JOIN res_partner company_p ON company_p.id = company.partner_id
+            LEFT JOIN res_country company_c ON company_c.id = company_p.country_id
+            WHERE p.id BETWEEN %s AND %s""", (self.start_id, self.end_id))
+        values = []
+        for partner_id, phone, mobile, country in cr.fetchall():
+            country = country or default_country
+            # Parse results are memoized by the phone service.
+            values.append((partner_id,
+                           normalize_phone(phone, country) if phone else None,
+                           normalize_phone(mobile, country) if mobile else None))
+        for i in range(0, len(values), UPDATE_SIZE):
+            rows = values[i:i + UPDATE_SIZE]
+            cr.execute("""
+                UPDATE res_partner p
+                SET phone_normalized = v.phone, mobile_normalized = v.mobile
+                FROM (VALUES {}) AS v(id, phone, mobile)
+                WHERE p.id = v.id AND (
+                    p.phone_normalized IS DISTINCT FROM v.phone OR
+                    p.mobile_normalized IS DISTINCT FROM v.mobile)
+            """.format(', '.join(['(%s, %s::varchar, %s::varchar)'] * len(rows))),
+                [value for row in rows for value in row])
+        partners = self.env['res.partner'].with_context(active_test=False).browse(
+            [row[0] for row in values])
+        if tools.odoo.release.version_info[0] >= 16:
+            partners.invalidate_recordset(['phone_normalized', 'mobile_normalized'])
+        else:
+            partners.invalidate_cache(['phone_normalized', 'mobile_normalized'], partners.ids)
+        partners._update_number_index(log_changes=False)
+        return len(values)
+
+    @api.model
+    def get_progress(self):
+        """Job progress.
+        Returns:
+            dict with chunk counts by state, processed partners and percent done.
+        """
+        self.env.cr.execute("""
+            SELECT state, count(*), coalesce(sum(processed), 0)
+            FROM asterisk_plus_phone_normalize_chunk GROUP BY state""")
+        res = {'pending': 0, 'done': 0, 'failed': 0, 'partners': 0}
+        for state, count, processed in self.env.cr.fetchall():
+            res[state] = count
+            res['partners'] += processed
+        total = res['pending'] + res['done'] + res['failed']
+        res['total'] = total
+        res['percent'] = round(100.0 * (total - res['pending']) / total, 1) if total else 100.0
+        return res
+
+    @api.model
+    def retry_failed(self):
+        """Put failed chunks back in the queue."""
+        self.search([('state', '=', 'failed')]).write({'state': 'pending', 'error': False})
+        self._trigger_cron()
@@ -10,6 +10,7 @@ from odoo import models, fields, api, _, tools, release, SUPERUSER_ID
 from odoo.exceptions import ValidationError
 from .server import debug
 from .settings import MODULE_NAME
+from .metrics import timed
 
 logger = logging.getLogger(__name__)
 
@@ -113,25 +114,20 @@ class Recording(models.Model):
         recording_channel_data = self.env['asterisk_plus.channel_data'].search(
             [('channel', '=', channel.id), ('key', '=', 'recording_file_path')], limit=1)
         if not recording_channel_data:
-            debug(self, 'Recording file not specified for channel {}, id: {}'.format(
-                channel.channel, channel.id))
+            debug(self, 'Recording file not specified for channel %s, id: %s', channel.channel, channel.id)
             return False
         recording_file_path = recording_channel_data.value
-        debug(self, 'Channel %s getting recording from %s' % (
-            channel.channel, recording_file_path))
+        debug(self, 'Channel %s getting recording from %s', channel.channel, recording_file_path)
         # Get recording access settings.
+        settings = self.env['asterisk_plus.settings'].sudo().get_settings()
         kwargs = {
-            'recordings_access': self.env['asterisk_plus.settings'].sudo().get_param('recordings_access'),
-            'recordings_access_url': self.env['asterisk_plus.settings'].sudo().get_param('recordings_access_url'),
+            'recordings_access': settings.recordings_access,
+            'recordings_access_url': settings.recordings_access_url,
         }
-        mp3_encode = self.env['asterisk_plus.settings'].sudo().get_param(
-            'use_mp3_encoder')
-        if mp3_encode:
+        if settings.use_mp3_encoder:
             kwargs['file_format'] = 'mp3'
-            kwargs['mp3_bitrate'] = int(self.env['asterisk_plus.settings'].sudo().get_param(
-                'mp3_encoder_bitrate', default='96'))
-            kwargs['mp3_quality'] = int(self.env['asterisk_plus.settings'].sudo().get_param(
-                'mp3_encoder_quality', default=4))
+            kwargs['mp3_bitrate'] = int(settings.mp3_encoder_bitrate or '96')
+            kwargs['mp3_quality'] = int(settings.mp3_encoder_quality or 4)
         channel.server.local_job(
             fun='recording.get_file',
             args=recording_file_path,
@@ -139,18 +135,19 @@ class Recording(models.Model):
             res_model='asterisk_plus.recording',
             res_method='upload_recording',
             pass_back={'channel_id': channel.id, 'file_path': recording_file_path},
-            raise_exc=False,
+            deferred=True,
         )
         return True
 
     @api.model
+    @timed
     def upload_recording(self, data, channel_id=None, file_path=None):
         """Upload call recording to Odoo."""
         if data == False:
-            debug(self, 'No recording {} to upload for channel {}'.format(file_path, channel_id))
+            debug(self, 'No recording %s to upload for channel %s', file_path, channel_id)
             return False
         if not isinstance(data, dict):
-            debug(self, 'Upload recording error: {}'.format(data))
+            debug(self, 'Upload recording error: %s', data)
             return False
         if data.get('error'):
             logger.error('Cannot get call recoding: %s', data['error'])
@@ -158,8 +155,13 @@ class Recording(models.Model):
         file_data = data.get('file_data')
         file_name = data.get('file_name')
         channel = self.env['asterisk_plus.channel'].browse(channel_id)
-        debug(self, 'Call recording upload for channel {}'.format(
-            channel.channel))
+        # The job is sent again when the Agent reply is lost, keep one copy.
+        if self.search_count([('uniqueid', '=', channel.uniqueid),
+                              ('recording_filename', '=', file_name)]):
+            debug(self, 'Call recording %s of channel %s is already uploaded',
+                  file_name, channel.channel)
+            return True
+        debug(self, 'Call recording upload for channel %s', channel.channel)
         vals = {
             'uniqueid': channel.uniqueid,            
             'recording_filename': data['file_name'],
@@ -185,7 +187,7 @@ class Recording(models.Model):
             channel.server.local_job(
                 fun='file.delete',
                 args=file_path,
-                raise_exc=False,
+                deferred=True,
             )
         return True
 
@@ -214,6 +216,8 @@ class Recording(models.Model):
             'key': 'minivm_filename',
             'value': filename,
         })
+        # MVM_DURATION could come first.
+        self.env['asterisk_plus.pending_event'].replay('channel_data', uniqueid)
         return True
 
     @api.model
@@ -226,7 +230,7 @@ class Recording(models.Model):
             ('key', '=', 'minivm_filename')])
         if channel_data:
             filename = '{}.WAV'.format(channel_data[0].value)
-            debug(self, 'Found MINIVM_FILENAME {}'.format(filename))
+            debug(self, 'Found MINIVM_FILENAME %s', filename)
             channel = self.env['asterisk_plus.channel'].search([('uniqueid', '=', uniqueid)])
             if not channel:
                 logger.warning('Channel not found by uniquid %s, cannot upload VoiceMail.', uniqueid)
@@ -248,9 +252,14 @@ class Recording(models.Model):
                 res_model='asterisk_plus.recording',
                 res_method='upload_voicemail',
                 pass_back={'channel_id': channel.id, 'file_path': filename},
-                raise_exc=False,
+                deferred=True,
             )
             return True
+        elif not self.env.context.get('pending_expired'):
+            self.env['asterisk_plus.pending_event'].park(
+                'channel_data', uniqueid, 'update_mvm_duration', event,
+                model='asterisk_plus.recording')
+            return False
         else:
             logger.warning('Could not get MINIVM_FILENAME from channel data!')
             return False
@@ -259,10 +268,10 @@ class Recording(models.Model):
     def upload_voicemail(self, data, channel_id=None, file_path=None):
         """Upload voicemail to Odoo."""
         if data == False:
-            debug(self, 'No voicemail {} to upload for channel {}'.format(file_path, channel_id))
+            debug(self, 'No voicemail %s to upload for channel %s', file_path, channel_id)
             return False
         if not isinstance(data, dict):
-            debug(self, 'Upload voicemail error: {}'.format(data))
+            debug(self, 'Upload voicemail error: %s', data)
             return False
         if data.get('error'):
             logger.error('Cannot get voicemail: %s', data['error'])
@@ -271,7 +280,7 @@ class Recording(models.Model):
         file_name = data.get('file_name')
         channel = self.env['asterisk_plus.channel'].browse(channel_id)
         if channel and channel.call:
-            debug(self, 'Voicemail upload for channel {}'.format(channel.channel))
+            debug(self, 'Voicemail upload for channel %s', channel.channel)
             vals = {
                 'voicemail_filename': data['file_name'],
                 'voicemail_data': file_data
@@ -279,7 +288,7 @@ class Recording(models.Model):
             channel.call.write(vals)
             return True
         else:
-            debug(self, 'No call for channel {} to upload voicemail.'.format(channel.id))
+            debug(self, 'No call for channel %s to upload voicemail.', channel.id)
             return False
 
     def _get_icon(self):
@@ -5,12 +5,28 @@ import re
 import phonenumbers
 from phonenumbers import phonenumberutil
 from odoo import models, fields, api, tools, _
+from odoo.osv import expression
 from .settings import debug, MAX_EXTEN_LEN
+from .cache import LRUCache
 
 logger = logging.getLogger(__name__)
 
 # Skip searching for numbers less then MAX_EXTEN_LEN
 
+#: Worker local negative cache: (dbname, number, country) -> versions of all
+#: numbers and of the number key when it was searched.
+unknown_numbers = LRUCache(maxsize=10000)
+#: Version key of all numbers, for bulk index changes.
+ALL_NUMBERS_KEY = ''
+#: Partner fields that change caller directory names.
+DIRECTORY_FIELDS = {'name', 'parent_id', 'is_company', 'active'}
+#: Number kinds exported to the caller directory, national ones are ambiguous.
+DIRECTORY_KINDS = ('e164', 'stripped')
+#: Numbers resolved per batch of the caller directory export.
+DIRECTORY_BATCH = 1000
+#: Parameter with the last transaction id of vacuumed directory changes.
+DIRECTORY_VACUUMED_PARAM = 'asterisk_plus.caller_directory_vacuumed'
+
 
 def strip_number(number):
     """Strip number formating"""
@@ -19,32 +35,107 @@ def strip_number(number):
     pattern = r'[\s\(\)\-\+]'
     return re.sub(pattern, '', number).lstrip('0')
 
+#: Marks a missing entry of the phone cache, False is a cached result.
+NOT_CACHED = object()
+
+
+class PhoneService(object):
+    """Worker local memoized phonenumbers parsing and formatting.
+    Results are cached by (number, country, format_type) in a bounded LRU
+    cache, its hits and misses are the counters of the service.
+    Formats:
+        e164: E.164 if the number is possible, otherwise False.
+        normalized: value of *_normalized partner fields.
+        national: national significant number of an international number or False.
+    """
+
+    def __init__(self, maxsize=20000):
+        self.cache = LRUCache(maxsize=maxsize)
+
+    def format(self, number, country=None, format_type='e164'):
+        key = (number, country, format_type)
+        res = self.cache.get(key, NOT_CACHED)
+        if res is NOT_CACHED:
+            res = self._format(number, country, format_type)
+            self.cache.set(key, res)
+        return res
+
+    def _format(self, number, country, format_type):
+        if format_type == 'normalized':
+            return self._normalize(number, country)
+        try:
+            phone_nbr = phonenumbers.parse(number, country)
+            if format_type == 'national':
+                return str(phone_nbr.national_number)
+            if not phonenumbers.is_possible_number(phone_nbr):
+                return False
+            # We have a parsed number, let check what format to return.
+            elif format_type == 'e164':
+                return phonenumbers.format_number(
+                    phone_nbr, phonenumbers.PhoneNumberFormat.E164)
+            else:
+                logger.error('WRONG FORMATTING PASSED: %s', format_type)
+        except phonenumberutil.NumberParseException:
+            pass
+        except Exception:
+            logger.exception('FORMAT NUMBER ERROR: ')
+        return False
+
+    def _normalize(self, number, country):
+        try:
+            phone_nbr = phonenumbers.parse(number, country)
+            if phonenumbers.is_possible_number(phone_nbr) or \
+                    phonenumbers.is_valid_number(phone_nbr):
+                number = phonenumbers.format_number(
+                    phone_nbr, phonenumbers.PhoneNumberFormat.E164)
+        except phonenumbers.phonenumberutil.NumberParseException:
+            # Force the number to be E.164 format.
+            number = '+{}'.format(strip_number(number))
+        except Exception as e:
+            logger.warning('Normalize phone error: %s', e)
+        # Strip the number if parse error.
+        return number
+
+
+phone_service = PhoneService()
+
+
 def format_number(self, number, country=None, format_type='e164'):
     """Return number in requested format_type
     """
-    res = False
-    try:
-        phone_nbr = phonenumbers.parse(number, country)
-        if not phonenumbers.is_possible_number(phone_nbr):
-            debug(self, '{} country {} parse impossible'.format(
-                number, country
-            ))
-        # We have a parsed number, let check what format to return.
-        elif format_type == 'e164':
-            res = phonenumbers.format_number(
-                phone_nbr, phonenumbers.PhoneNumberFormat.E164)
-        else:
-            logger.error('WRONG FORMATTING PASSED: %s', format_type)
-    except phonenumberutil.NumberParseException:
-        debug(self, '{} {} {} got NumberParseException'.format(
-            number, country, format_type
-        ))
-    except Exception:
-        logger.exception('FORMAT NUMBER ERROR: ')
-    finally:
-        debug(self, '{} county {} format {}: {}'.format(
-            number, country, format_type, res))
-        return res or number
+    res = phone_service.format(number, country, format_type)
+    debug(self, '%s county %s format %s: %s', number, country, format_type, res)
+    return res or number
+
+def normalize_phone(number, country=None):
+    """Normalized form of a partner phone number kept in *_normalized fields.
+    """
+    return phone_service.format(number, country, 'normalized')
+
+def reverse_digits(number):
+    """Digits of the number in reverse order, the suffix search key."""
+    return re.sub(r'\D', '', number or '')[::-1]
+
+def unknown_number_key(number):
+    """Version key of the unknown number cache: the last MAX_EXTEN_LEN digits.
+    Equal and suffix matches of a number share them, the variants too.
+    """
+    return re.sub(r'\D', '', number or '')[-MAX_EXTEN_LEN:]
+
+def get_number_variants(number):
+    """Lookup variants of a normalized number.
+    Returns dict {variant: kind}, E.164 first.
+    """
+    variants = {}
+    if not number:
+        return variants
+    variants[number] = 'e164'
+    variants.setdefault(strip_number(number), 'stripped')
+    national = phone_service.format(number, None, 'national')
+    if national:
+        variants.setdefault(national, 'national')
+    variants.pop('', None)
+    return variants
 
 
 class Partner(models.Model):
@@ -75,31 +166,76 @@ class Partner(models.Model):
         except Exception as e:
             logger.exception(e)
         res = super().create(vals)
-        if res and not self.env.context.get('no_clear_cache'):
-            if tools.odoo.release.version_info[0] >= 17:
-                self.env.registry.clear_cache()
-            else:
-                self.clear_caches()
+        if res.filtered(lambda r: r.phone or r.mobile):
+            res._update_number_index()
         return res
 
     def write(self, values):
         res = super().write(values)
-        if res and not self.env.context.get('no_clear_cache'):
-            if tools.odoo.release.version_info[0] >= 17:
-                self.env.registry.clear_cache()
-            else:
-                self.clear_caches()
+        # Only phone changes touch the number index, other edits are free.
+        if res and set(values) & {'phone', 'mobile', 'country_id'}:
+            self._update_number_index()
+        elif res and set(values) & DIRECTORY_FIELDS:
+            # Names in the caller directory change.
+            index = self.env['asterisk_plus.partner_number'].sudo()
+            index.log_changes(index.search([('partner', 'in', self.ids)]).mapped('number'))
         return res
 
     def unlink(self):
+        index = self.env['asterisk_plus.partner_number'].sudo()
+        numbers = index.search([('partner', 'in', self.ids)]).mapped('number')
         res = super().unlink()
-        if res and not self.env.context.get('no_clear_cache'):
-            if tools.odoo.release.version_info[0] >= 17:
-                self.env.registry.clear_cache()
-            else:
-                self.clear_caches()
+        index.log_changes(numbers)
         return res
 
+    def _update_number_index(self, log_changes=True):
+        """Index the partner numbers.
+        Without log_changes the caller directory and unknown numbers are not
+        told, the caller publishes all changes at once.
+        """
+        index = self.env['asterisk_plus.partner_number'].sudo()
+        old_index = index.search([('partner', 'in', self.ids)])
+        old_numbers = set(old_index.mapped('number'))
+        # User numbers are used in DID routing.
+        user_partners = self.sudo().with_context(active_test=False).filtered('user_ids')
+        # The partner numbers are written already, the index has the old ones.
+        old_dids = set(old_index.filtered(
+            lambda r: r.kind == 'e164' and r.partner in user_partners).mapped('number'))
+        old_index.unlink()
+        vals = []
+        for rec in self:
+            variants = {}
+            for number in (rec.phone_normalized, rec.mobile_normalized):
+                for variant, kind in get_number_variants(number).items():
+                    variants.setdefault(variant, kind)
+            vals.extend({'partner': rec.id, 'number': variant, 'kind': kind,
+                         'number_reversed': reverse_digits(variant) if kind == 'e164' else False}
+                        for variant, kind in variants.items())
+        if vals:
+            index.create(vals)
+        if log_changes:
+            new_numbers = set(v['number'] for v in vals)
+            index.log_changes(old_numbers | new_numbers)
+            # Only added numbers can match a number that was unknown.
+            self._evict_unknown_numbers(new_numbers - old_numbers)
+        if user_partners:
+            self.env['asterisk_plus.user']._evict_did_routes(
+                old_dids | set(user_partners.mapped('phone_normalized')))
+
+    @api.model
+    def _evict_unknown_numbers(self, numbers=None):
+        """Forget unknown numbers in all workers that may match the numbers,
+        all of them without numbers. The key rows are written in this
+        transaction so other workers see them together with the numbers.
+        """
+        if not self._use_unknown_numbers(
+                self.env['asterisk_plus.settings'].sudo().get_settings()):
+            return
+        keys = set(unknown_number_key(number) for number in numbers) \
+            if numbers is not None else {ALL_NUMBERS_KEY}
+        if keys:
+            self.env['asterisk_plus.number_version'].sudo().bump(keys)
+
     @api.model
     def originate_call(self, number, model=None, res_id=None, exten=None):
         """Originate Call to partner.
@@ -132,20 +268,7 @@ class Partner(models.Model):
         """Keep normalized phone numbers in normalized fields.
         """
         self.ensure_one()
-        country = self._get_country()
-        try:
-            phone_nbr = phonenumbers.parse(number, country)
-            if phonenumbers.is_possible_number(phone_nbr) or \
-                    phonenumbers.is_valid_number(phone_nbr):
-                number = phonenumbers.format_number(
-                    phone_nbr, phonenumbers.PhoneNumberFormat.E164)
-        except phonenumbers.phonenumberutil.NumberParseException:
-            # Force the number to be E.164 format.
-            number = '+{}'.format(strip_number(number))
-        except Exception as e:
-            logger.warning('Normalize phone error: %s', e)
-        # Strip the number if parse error.
-        return number
+        return normalize_phone(number, self._get_country())
 
     def search_by_number(self, number):
         """Search partner by number.
@@ -155,15 +278,121 @@ class Partner(models.Model):
         a) If partners belong to same company, return company record.
         b) If partners belong to different companies return False.
         """
+        found = self._search_numbers([number]).get(number, self.browse())
+        debug(self, '%s belongs to partners: %s', number, found.mapped('id'))
+        return self._resolve_partners(number, found)
+
+    def _search_numbers(self, numbers):
+        """Search partners of many numbers with one query according to the
+        number_search_operation setting.
+        Returns dict {number: partners} of the found numbers.
+        """
         search_operation = self.env['asterisk_plus.settings'].sudo(
             ).get_param('number_search_operation')
-        found = self.search([
-            '|',
-            ('phone_normalized', search_operation, number),
-            ('mobile_normalized', search_operation, number)])
-        debug(self, '{} belongs to partners: {}'.format(
-            number, found.mapped('id')
-        ))
+        if search_operation == '=':
+            return self._search_number_index_many(numbers)
+        elif search_operation == 'suffix':
+            return self._search_number_suffix_many(numbers)
+        domain = []
+        for number in numbers:
+            domain = expression.OR([domain, [
+                '|',
+                ('phone_normalized', search_operation, number),
+                ('mobile_normalized', search_operation, number)]])
+        partners = self.search(domain) if domain else self.browse()
+        res = {}
+        for number in numbers:
+            # Odoo 'like' is a case sensitive substring match.
+            found = partners.filtered(
+                lambda r: number in (r.phone_normalized or '') or
+                number in (r.mobile_normalized or ''))
+            if found:
+                res[number] = found
+        return res
+
+    def _search_number_index_many(self, numbers):
+        """Partners of many numbers with one index query on E.164 and
+        stripped variants. National variants are ambiguous between countries,
+        see _search_national_many.
+        Returns dict {number: partners} of the found numbers.
+        """
+        self.env.cr.execute("""
+            SELECT number, partner FROM asterisk_plus_partner_number
+            WHERE number = ANY(%s) AND kind != 'national'""", (list(numbers),))
+        return self._get_partners_by_rows(self.env.cr.fetchall())
+
+    def _search_national_many(self, numbers, country):
+        """Partners whose national number is one of the numbers, limited to
+        numbers of the country. Used when nothing else matched.
+        Returns dict {number: partners} of the found numbers.
+        """
+        country_code = phonenumbers.country_code_for_region(country.upper()) if country else 0
+        if not country_code or not numbers:
+            return {}
+        self.env.cr.execute("""
+            SELECT n.number, n.partner FROM asterisk_plus_partner_number n
+            JOIN asterisk_plus_partner_number e ON e.partner = n.partner
+                AND e.kind = 'e164' AND e.number = %s || n.number
+            WHERE n.kind = 'national' AND n.number = ANY(%s)""",
+            ('+{}'.format(country_code), list(numbers)))
+        return self._get_partners_by_rows(self.env.cr.fetchall())
+
+    def _get_partners_by_rows(self, rows):
+        partner_ids = {}
+        for number, partner_id in rows:
+            partner_ids.setdefault(number, set()).add(partner_id)
+        if not partner_ids:
+            return {}
+        # Apply access rules and active filter like a regular search.
+        partners = self.search([('id', 'in', list(set().union(*partner_ids.values())))])
+        res = {}
+        for number, ids in partner_ids.items():
+            found = partners.filtered(lambda r: r.id in ids)
+            if found:
+                res[number] = found
+        return res
+
+    def _search_number_suffix_many(self, numbers):
+        """Partners whose number ends with the number or is its ending, at
+        least MAX_EXTEN_LEN digits. Uses the reversed number index, so it does
+        not scan all partners like the 'like' operation.
+        Returns dict {number: partners} of the found numbers.
+        """
+        reversed_numbers = dict((number, reverse_digits(number)) for number in numbers)
+        reversed_numbers = dict((k, v) for k, v in reversed_numbers.items()
+                                if len(v) >= MAX_EXTEN_LEN)
+        if not reversed_numbers:
+            return {}
+        patterns = [v + '%' for v in set(reversed_numbers.values())]
+        endings = list(set(v[:i] for v in reversed_numbers.values()
+                           for i in range(MAX_EXTEN_LEN, len(v))))
+        # One constant prefix LIKE per number, LIKE ANY(array) cannot use
+        # the pattern ops index. Reversed numbers are digits only.
+        conditions = ['number_reversed LIKE %s'] * len(patterns)
+        params = list(patterns)
+        if endings:
+            conditions.append('number_reversed = ANY(%s)')
+            params.append(endings)
+        self.env.cr.execute("""
+            SELECT DISTINCT partner, number_reversed FROM asterisk_plus_partner_number
+            WHERE {}""".format(' OR '.join(conditions)), params)
+        rows = self.env.cr.fetchall()
+        if not rows:
+            return {}
+        partners = self.search([('id', 'in', list(set(row[0] for row in rows)))])
+        res = {}
+        for number, reversed_number in reversed_numbers.items():
+            ids = set(partner_id for partner_id, stored in rows
+                      if stored.startswith(reversed_number) or
+                      reversed_number.startswith(stored))
+            found = partners.filtered(lambda r: r.id in ids)
+            if found:
+                res[number] = found
+        return res
+
+    def _resolve_partners(self, number, found):
+        """Pick one partner from the partners found by the number.
+        """
         parents = found.mapped('parent_id')
         # 1-st case: just one partner, perfect!
         if len(found) == 1:
@@ -187,7 +416,7 @@ class Partner(models.Model):
         # 5-rd case: many partners same parent company
         elif len(parents) == 1 and len(found) > 1 and len(found.filtered(
                 lambda r: r.parent_id in [k for k in parents])) > 1:
-            debug(self, 'MANY PARTNERS SAME PARENT COMPANY {}'.format(number))
+            debug(self, 'MANY PARTNERS SAME PARENT COMPANY %s', number)
             return parents[0]
 
     def _get_country(self):
@@ -206,45 +435,169 @@ class Partner(models.Model):
             return self.env.user.company_id.country_id.code
 
     @api.model
-    @tools.ormcache('number', 'country')
-    def get_partner_by_number(self, number, country=None):
+    def _get_number_candidates(self, number, country=None):
+        """Numbers to search for a caller number in order of preference.
+        Returns (stripped number, candidates), no candidates if the number
+        must not be searched.
+        """
         number = strip_number(number)
         if (not number or 'unknown' in number or
             number == 's' or len(number) < MAX_EXTEN_LEN
         ):
-            debug(self, '{} skip search'.format(number))
-            return {'name': _('Unknown'), 'id': False}
-        partner = None
-        # Search by stripped number prefixed with '+'
-        number_plus = '+' + number
-        partner = self.search_by_number(number_plus)
-        if partner:
-            return {'id': partner.id, 'name': partner.display_name }
-        # Search by stripped number
-        partner = self.search_by_number(number)
-        if partner:
-            return {'id': partner.id, 'name': partner.display_name }
-        # Search by number in e164 format
+            debug(self, '%s skip search', number)
+            return number, []
+        # Stripped number prefixed with '+', stripped number, E.164 format.
+        candidates = ['+' + number, number]
         e164_number = format_number(self,
             number, country=country, format_type='e164')
-        if e164_number and e164_number not in [number, number_plus]:
-            partner = self.search_by_number(e164_number)
-        if partner:
-            return {'id': partner.id, 'name': partner.display_name }
-        else:
+        if e164_number and e164_number not in candidates:
+            candidates.append(e164_number)
+        return number, candidates
+
+    @api.model
+    def _use_unknown_numbers(self, settings):
+        # New partners are created for unknown numbers, they must be searched.
+        # Partial matches of 'like' have no number key.
+        return bool(settings.unknown_number_cache_ttl and settings.unknown_number_cache_size and
+                    not settings.auto_create_partners and
+                    settings.number_search_operation != 'like')
+
+    @api.model
+    def _get_unknown_number_versions(self, numbers, settings):
+        """Versions of the number keys for the unknown number cache, None if
+        the cache is not used. They are read before the search so the numbers
+        found are not newer than the versions.
+        """
+        if not self._use_unknown_numbers(settings):
+            return None
+        return self.env['asterisk_plus.number_version'].sudo().get_versions(
+            [unknown_number_key(number) for number in numbers] + [ALL_NUMBERS_KEY])
+
+    @api.model
+    def _is_unknown_number(self, number, country, versions):
+        if versions is None:
+            return False
+        cached = unknown_numbers.get((self.env.cr.dbname, number, country))
+        if cached is not None and cached == (
+                versions[ALL_NUMBERS_KEY], versions[unknown_number_key(number)]):
+            debug(self, '%s is a known unknown number', number)
+            return True
+        return False
+
+    @api.model
+    def _set_unknown_number(self, number, country, versions, settings):
+        if versions is not None:
+            unknown_numbers.maxsize = settings.unknown_number_cache_size
+            unknown_numbers.set(
+                (self.env.cr.dbname, number, country),
+                (versions[ALL_NUMBERS_KEY], versions[unknown_number_key(number)]),
+                ttl=settings.unknown_number_cache_ttl)
+
+    @api.model
+    def get_partner_by_number(self, number, country=None):
+        number, candidates = self._get_number_candidates(number, country)
+        if not candidates:
+            return {'name': _('Unknown'), 'id': False}
+        settings = self.env['asterisk_plus.settings'].sudo().get_settings()
+        versions = self._get_unknown_number_versions([number], settings)
+        if self._is_unknown_number(number, country, versions):
             return {'name': _('Unknown'), 'id': False}
+        # All candidates with one query, then the first one that resolves.
+        found = self._search_numbers(candidates)
+        for candidate in candidates:
+            if candidate not in found:
+                continue
+            debug(self, '%s belongs to partners: %s', candidate, found[candidate].mapped('id'))
+            partner = self._resolve_partners(candidate, found[candidate])
+            if partner:
+                return {'id': partner.id, 'name': partner.display_name,
+                        'matched_number': candidate}
+        if settings.number_search_operation == '=':
+            # National numbers of the caller country only after all candidates missed.
+            found = self._search_national_many([number], country).get(number)
+            partner = found and self._resolve_partners(number, found)
+            if partner:
+                return {'id': partner.id, 'name': partner.display_name,
+                        'matched_number': number}
+        self._set_unknown_number(number, country, versions, settings)
+        return {'name': _('Unknown'), 'id': False}
+
+    @api.model
+    def get_partners_by_numbers(self, numbers, country=None):
+        """Resolve many caller numbers at once.
+        All numbers are resolved with one search, the partner is chosen by
+        the same rules as get_partner_by_number.
+        Returns:
+            dict {number: {'id': partner id, 'name': partner name}}.
+        """
+        settings = self.env['asterisk_plus.settings'].sudo().get_settings()
+        res = {}
+        searched = {}
+        for number in numbers:
+            stripped, candidates = self._get_number_candidates(number, country)
+            if candidates:
+                searched[number] = (stripped, candidates)
+            else:
+                res[number] = {'name': _('Unknown'), 'id': False}
+        versions = self._get_unknown_number_versions(
+            [stripped for stripped, candidates in searched.values()], settings)
+        pending = {}
+        for number, (stripped, candidates) in searched.items():
+            if self._is_unknown_number(stripped, country, versions):
+                res[number] = {'name': _('Unknown'), 'id': False}
+            else:
+                pending[number] = (stripped, candidates)
+        found = self._search_numbers(list(
+            set(c for stripped, candidates in pending.values() for c in candidates)))
+        missed = {}
+        for number, (stripped, candidates) in pending.items():
+            partner = None
+            for candidate in candidates:
+                if candidate in found:
+                    partner = self._resolve_partners(candidate, found[candidate])
+                    if partner:
+                        break
+            if partner:
+                res[number] = {'id': partner.id, 'name': partner.display_name,
+                               'matched_number': candidate}
+            else:
+                missed[number] = (stripped, candidates)
+        # National numbers of the caller country only after all candidates missed.
+        national = {}
+        if missed and settings.number_search_operation == '=':
+            national = self._search_national_many(
+                list(set(stripped for stripped, candidates in missed.values())), country)
+        for number, (stripped, candidates) in missed.items():
+            partner = stripped in national and self._resolve_partners(stripped, national[stripped])
+            if partner:
+                res[number] = {'id': partner.id, 'name': partner.display_name,
+                               'matched_number': stripped}
+            else:
+                self._set_unknown_number(stripped, country, versions, settings)
+                res[number] = {'name': _('Unknown'), 'id': False}
+        return res
 
     def _get_call_count(self):
+        # One grouped query for all records, calls of company contacts
+        # are added to the company.
+        ids = [rec.id for rec in self if isinstance(rec.id, int)]
+        company_ids = [rec.id for rec in self if isinstance(rec.id, int) and rec.is_company]
+        counts = dict.fromkeys(ids, 0)
+        if ids:
+            domain = [('partner', 'in', ids)]
+            if company_ids:
+                domain = ['|'] + domain + [('partner.parent_id', 'in', company_ids)]
+            groups = self.env['asterisk_plus.call'].sudo().read_group(
+                domain, ['partner'], ['partner'])
+            call_partners = self.env['res.partner'].sudo().browse(
+                [group['partner'][0] for group in groups])
+            for group, partner in zip(groups, call_partners):
+                if partner.id in counts:
+                    counts[partner.id] += group['partner_count']
+                if partner.parent_id.id in company_ids:
+                    counts[partner.parent_id.id] += group['partner_count']
         for rec in self:
-            if rec.is_company:
-                rec.call_count = self.env[
-                    'asterisk_plus.call'].sudo().search_count(
-                    ['|', ('partner', '=', rec.id),
-                          ('partner.parent_id', '=', rec.id)])
-            else:
-                rec.call_count = self.env[
-                    'asterisk_plus.call'].sudo().search_count(
-                    [('partner', '=', rec.id)])
+            rec.call_count = counts.get(rec.id, 0)
     
     def _phone_format(self, number=None, country=None, company=None, force_format='E164', **kwargs):
         disable = self.env['asterisk_plus.settings'].get_param('disable_phone_format')
@@ -263,3 +616,212 @@ class Partner(models.Model):
             fname = kwargs.get('fname', False)
             raise_exception = kwargs.get('raise_exception', False)
             return super(Partner, self)._phone_format(fname=fname, number=number, country=country, force_format=force_format, raise_exception=raise_exception)
+
+
+class PartnerNumber(models.Model):
+    """Index of partner phone numbers in all lookup variants.
+    Maintained on partner phone changes, so caller lookups are one indexed
+    probe that does not depend on the ORM cache.
+    """
+    _name = 'asterisk_plus.partner_number'
+    _description = 'Partner Number'
+    _rec_name = 'number'
+
+    partner = fields.Many2one('res.partner', ondelete='cascade', required=True, index=True)
+    number = fields.Char(required=True, index=True)
+    kind = fields.Selection([('e164', 'E.164'), ('stripped', 'Stripped'),
+                             ('national', 'National')], required=True)
+    #: Reversed digits of E.164 numbers for the suffix search.
+    number_reversed = fields.Char()
+
+    def init(self):
+        # Prefix LIKE on reversed digits needs the pattern ops index.
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS asterisk_plus_partner_number_reversed_idx
+            ON asterisk_plus_partner_number (number_reversed varchar_pattern_ops)
+            WHERE number_reversed IS NOT NULL""")
+        # Backfill existing partners once. National variants need
+        # libphonenumber and are added by the phone normalization job.
+        self.env.cr.execute('SELECT 1 FROM asterisk_plus_partner_number LIMIT 1')
+        if self.env.cr.fetchone():
+            self.env.cr.execute("""
+                UPDATE asterisk_plus_partner_number
+                SET number_reversed = reverse(regexp_replace(number, '\\D', '', 'g'))
+                WHERE kind = 'e164' AND number_reversed IS NULL""")
+            return
+        # Make sure normalized numbers of a fresh install are computed.
+        if tools.odoo.release.version_info[0] >= 16:
+            self.env['res.partner'].flush_model(['phone_normalized', 'mobile_normalized'])
+        else:
+            self.env['res.partner'].flush(['phone_normalized', 'mobile_normalized'])
+        self.env.cr.execute("""
+            INSERT INTO asterisk_plus_partner_number
+                (partner, number, kind, number_reversed, create_date, write_date)
+            SELECT DISTINCT p.id, v.number, v.kind,
+                   CASE WHEN v.kind = 'e164'
+                        THEN reverse(regexp_replace(v.number, '\\D', '', 'g')) END,
+                   now() at time zone 'UTC', now() at time zone 'UTC'
+            FROM res_partner p,
+                 LATERAL (VALUES (p.phone_normalized), (p.mobile_normalized)) n(number),
+                 LATERAL (VALUES
+                    (n.number, 'e164'),
+                    (ltrim(regexp_replace(n.number, '[\\s\\(\\)\\-\\+]', '', 'g'), '0'),
+                     'stripped')) v(number, kind)
+            WHERE n.number IS NOT NULL AND v.number <> ''
+              AND (v.kind = 'e164' OR v.number <> n.number)
+        """)
+
+    @api.model
+    def log_changes(self, numbers):
+        """Record numbers whose caller directory entry may have changed.
+        """
+        numbers = [k for k in set(numbers) if k]
+        if not numbers:
+            return
+        self.env.cr.execute("""
+            INSERT INTO asterisk_plus_partner_number_log (number, date, txid)
+            SELECT unnest(%s::varchar[]), now() at time zone 'UTC', txid_current()""",
+            (numbers,))
+
+    @api.model
+    def get_caller_directory(self, since=None):
+        """Caller ID directory for resolution on the PBX.
+        Args:
+            since (int): version of the previous export for a delta, full
+                export if not set or the changes are already vacuumed.
+        Returns:
+            (version, full, [(number, name)]), an empty name in a delta
+            means the number must be removed.
+        """
+        # Transactions before the snapshot xmin are all finished, so every
+        # change of them is visible now. Later ones may still commit and are
+        # sent again in the next delta. The xmin only grows, also when the
+        # changes are vacuumed.
+        self.env.cr.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+        version = self.env.cr.fetchone()[0]
+        vacuumed = int(self.env['ir.config_parameter'].sudo().get_param(
+            DIRECTORY_VACUUMED_PARAM) or 0)
+        full = not since or since <= vacuumed
+        if full:
+            self.env.cr.execute("""
+                SELECT number, partner FROM asterisk_plus_partner_number
+                WHERE kind IN %s ORDER BY number""", (DIRECTORY_KINDS,))
+            changed = None
+        else:
+            self.env.cr.execute("""
+                SELECT DISTINCT number FROM asterisk_plus_partner_number_log
+                WHERE txid >= %s""", (since,))
+            changed = [row[0] for row in self.env.cr.fetchall()]
+            self.env.cr.execute("""
+                SELECT number, partner FROM asterisk_plus_partner_number
+                WHERE kind IN %s AND number = ANY(%s) ORDER BY number""",
+                (DIRECTORY_KINDS, changed))
+        partner_ids = {}
+        for number, partner_id in self.env.cr.fetchall():
+            partner_ids.setdefault(number, []).append(partner_id)
+        entries = []
+        numbers = list(partner_ids)
+        partners = self.env['res.partner']
+        for i in range(0, len(numbers), DIRECTORY_BATCH):
+            batch = numbers[i:i + DIRECTORY_BATCH]
+            # Access rules and active filter like caller name lookups.
+            found = partners.search([('id', 'in', list(set(
+                p for number in batch for p in partner_ids[number])))])
+            for number in batch:
+                ids = set(partner_ids[number])
+                partner = found.filtered(lambda r: r.id in ids)
+                if len(partner) > 1:
+                    partner = partners._resolve_partners(number, partner)
+                entries.append((number, partner.display_name if partner else ''))
+        if changed is not None:
+            # Numbers removed from the index.
+            entries.extend((number, '') for number in set(changed) - set(partner_ids))
+        if full:
+            entries = [entry for entry in entries if entry[1]]
+        return version, full, entries
+
+    @api.model
+    def reset_caller_directory(self):
+        """Make all previous versions get a full export, for bulk changes
+        that are not logged.
+        """
+        self.env.cr.execute('SELECT txid_current()')
+        self.env['ir.config_parameter'].sudo().set_param(
+            DIRECTORY_VACUUMED_PARAM, str(self.env.cr.fetchone()[0]))
+
+    @api.model
+    def vacuum_log(self, days=7):
+        """Cron job to delete old directory changes, older deltas get a full export.
+        """
+        self.env.cr.execute("""
+            WITH deleted AS (
+                DELETE FROM asterisk_plus_partner_number_log
+                WHERE date < now() at time zone 'UTC' - %s * interval '1 day'
+                RETURNING txid)
+            SELECT max(txid) FROM deleted""", (days,))
+        vacuumed = self.env.cr.fetchone()[0]
+        params = self.env['ir.config_parameter'].sudo()
+        if vacuumed and vacuumed > int(params.get_param(DIRECTORY_VACUUMED_PARAM) or 0):
+            params.set_param(DIRECTORY_VACUUMED_PARAM, str(vacuumed))
+
+
+class PartnerNumberLog(models.Model):
+    """Changes of the caller directory. The transaction id of a change is
+    compared with the directory version, it is bigint and kept out of the ORM.
+    """
+    _name = 'asterisk_plus.partner_number_log'
+    _description = 'Partner Number Change'
+    _order = 'id'
+    _log_access = False
+
+    number = fields.Char(required=True, index=True)
+    date = fields.Datetime(index=True)
+
+    def init(self):
+        self.env.cr.execute("""
+            ALTER TABLE asterisk_plus_partner_number_log
+            ADD COLUMN IF NOT EXISTS txid bigint""")
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS asterisk_plus_partner_number_log_txid_idx
+            ON asterisk_plus_partner_number_log (txid)""")
+
+
+class NumberVersion(models.Model):
+    """Versions of the unknown number cache keys, see unknown_number_key,
+    and of the DID route keys, see did_route_key.
+    A bump takes new values from a sequence and locks only its key rows.
+    """
+    _name = 'asterisk_plus.number_version'
+    _description = 'Unknown Number Cache Version'
+    _log_access = False
+
+    key = fields.Char()
+    version = fields.Integer(required=True)
+
+    _sql_constraints = [
+        ('key_unique', 'UNIQUE(key)', 'The number key must be unique!'),
+    ]
+
+    def init(self):
+        self.env.cr.execute(
+            'CREATE SEQUENCE IF NOT EXISTS asterisk_plus_number_version_seq')
+
+    @api.model
+    def bump(self, keys):
+        # Sorted keys lock their rows in the same order in all transactions.
+        self.env.cr.execute("""
+            INSERT INTO asterisk_plus_number_version (key, version)
+            SELECT key, nextval('asterisk_plus_number_version_seq')
+            FROM unnest(%s::varchar[]) AS key ORDER BY key
+            ON CONFLICT (key) DO UPDATE SET version = EXCLUDED.version""",
+            (sorted(keys),))
+
+    @api.model
+    def get_versions(self, keys):
+        """Returns dict {key: version}, 0 for keys never bumped."""
+        keys = list(set(keys))
+        self.env.cr.execute("""
+            SELECT key, version FROM asterisk_plus_number_version
+            WHERE key = ANY(%s)""", (keys,))
+        versions = dict(self.env.cr.fetchall())
+        return dict((key, versions.get(key, 0)) for key in keys)
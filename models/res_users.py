@@ -27,6 +27,17 @@ class ResUser(models.Model):
             self.env['asterisk_plus.user'].auto_create(user)
         return user
 
+    def write(self, vals):
+        res = super().write(vals)
+        # Number changes are evicted by the partner number index.
+        if 'active' in vals:
+            self.env['asterisk_plus.user']._evict_did_routes(self.mapped('phone_normalized'))
+        return res
+
+    def unlink(self):
+        self.env['asterisk_plus.user']._evict_did_routes(self.mapped('phone_normalized'))
+        return super().unlink()
+
     @api.constrains('groups_id')
     def _manage_pbx_users(self):
         if self.env.context.get('install_mode'):
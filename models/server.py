@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2023
 import base64
-from datetime import datetime
+from datetime import datetime, timedelta
+import hashlib
 import json
 import logging
+import os
 import requests
+from requests.adapters import HTTPAdapter
+import threading
 import time
 import unicodedata
 import urllib
@@ -18,12 +22,88 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 import uuid
 from odoo import api, models, fields, SUPERUSER_ID, registry, release, tools, _
 from odoo.exceptions import ValidationError, UserError
+from odoo.modules.registry import Registry
 from .settings import debug
 from .res_partner import strip_number, format_number
+from .metrics import metrics, timed
+from .cache import LRUCache
+from .jobs import trigger_cron
+from .breaker import is_endpoint_failure, FAILURE_THRESHOLD, PROBE_INTERVAL, \
+    PROBE_LOCK_NAMESPACE, AGENT_STATES, CLOSED, OPEN, HALF_OPEN
 
 
 logger = logging.getLogger(__name__)
 
+#: Worker local rendered configs: (dbname, server id, kind) -> (etag, content).
+rendered_configs = LRUCache(maxsize=100)
+
+
+class AgentSession(object):
+    """Worker local keep-alive HTTP session to the agent API.
+    It is rebuilt when the API URL, key or pool size change and after a fork.
+    """
+
+    def __init__(self):
+        self.session = None
+        #: Sessions built since the worker start.
+        self.created = 0
+        self._key = None
+        # Requests and connections of the replaced sessions.
+        self._requests = 0
+        self._connections = 0
+        self._lock = threading.Lock()
+
+    def get(self, api_url, api_key, instance_uid, pool_size):
+        key = (os.getpid(), api_url, api_key, instance_uid, pool_size)
+        with self._lock:
+            if self.session is None or self._key != key:
+                if self.session is not None:
+                    requests_sent, connections = self._count(self.session)
+                    self._requests += requests_sent
+                    self._connections += connections
+                    self.session.close()
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.verify = False
+                session.headers.update({
+                    'x-api-key': api_key,
+                    'x-instance-uid': instance_uid,
+                })
+                self.session = session
+                self._key = key
+                self.created += 1
+            return self.session
+
+    @staticmethod
+    def _count(session):
+        requests_sent = connections = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is not None:
+                    requests_sent += pool.num_requests
+                    connections += pool.num_connections
+        return requests_sent, connections
+
+    def stats(self):
+        """Requests sent and connections opened since the worker start,
+        requests above connections went over reused connections.
+        """
+        with self._lock:
+            requests_sent, connections = self._count(self.session) if self.session else (0, 0)
+            return {
+                'requests': self._requests + requests_sent,
+                'connections': self._connections + connections,
+                'sessions': self.created,
+            }
+
+
+agent_session = AgentSession()
+
+
 DEFAULT_SIP_TEMPLATES="""
 [trunk_defaults](!)
 type = wizard
@@ -164,6 +244,14 @@ class Server(models.Model):
     tz = fields.Selection(related='user.tz', readonly=False)
     country_id = fields.Many2one(related='user.country_id', readonly=False)
     agent_initialized = fields.Boolean()
+    agent_batch_actions = fields.Boolean(
+        string='Batch AMI Actions',
+        help='Send several AMI actions in one request. Enable only when the Agent '
+             'supports asterisk.manager_actions.')
+    agent_state = fields.Selection(AGENT_STATES, string='Agent API', default=CLOSED,
+                                   required=True, readonly=True)
+    agent_failures = fields.Integer(readonly=True)
+    agent_opened_at = fields.Datetime(string='Agent API Unavailable Since', readonly=True)
     permit_agent_initialization = fields.Boolean(string='Permit Initialization', default=True)
     auto_create_pbx_users = fields.Boolean(string="Autocreate PBX Users",
         help="Automatically generate PBX users for Odoo users")
@@ -197,13 +285,40 @@ class Server(models.Model):
         ('user_unique', 'UNIQUE("user")', 'This user is already used for another server!'),
     ]
 
+    @api.model
+    def create(self, vals):
+        res = super().create(vals)
+        self._clear_token_cache()
+        return res
+
     def write(self, vals):
         res = super().write(vals)
+        if 'security_token' in vals:
+            self._clear_token_cache()
         autocreate_enabled =  vals.get('auto_create_pbx_users', False)
         if autocreate_enabled:
             self.run_auto_create_pbx_users()
         return res
 
+    def unlink(self):
+        res = super().unlink()
+        self._clear_token_cache()
+        return res
+
+    def _clear_token_cache(self):
+        if tools.odoo.release.version_info[0] >= 17:
+            self.env.registry.clear_cache()
+        else:
+            self.clear_caches()
+
+    @api.model
+    @tools.ormcache('token')
+    def _get_server_id_by_token(self, token):
+        """Server id by security token, False when the token is unknown.
+        """
+        server = self.sudo().search([('security_token', '=', token)], limit=1)
+        return server.id
+
     @api.constrains('agent_initialized')
     def _check_permit_initialization(self):
         for rec in self:
@@ -221,23 +336,71 @@ class Server(models.Model):
         if not self.generate_sip_peers:
             logger.info('SIP peers generation is not enabled.')
             return
-     
-        sip_content = '{}\n'.format(self.sip_templates)
+        sip_content = ['{}\n'.format(self.sip_templates)]
+        user_names = {}
         for channel in self.env['asterisk_plus.user_channel'].sudo().search(
                 [('server', '=', self.id)]):
             if not channel.sip_password:
                 logger.info('SIP channel %s has not password, not including.', channel.name)
                 continue
-            user_name = unicodedata.normalize('NFKD', channel.user.name).encode('ASCII', 'ignore').decode('ASCII')
-            sip_content += self.sip_peer_template.format(
+            asterisk_user = channel.asterisk_user
+            user_name = user_names.get(asterisk_user.id)
+            if user_name is None:
+                user_name = user_names[asterisk_user.id] = unicodedata.normalize(
+                    'NFKD', asterisk_user.user.name or '').encode('ASCII', 'ignore').decode('ASCII')
+            sip_content.append(self.sip_peer_template.format(
                 template=channel.sip_transport,
                 password=channel.sip_password,
                 username=channel.sip_user,
-                exten=channel.asterisk_user.exten,
-                callerid='{} <{}>'.format(user_name, channel.asterisk_user.exten)
-            )
-            sip_content += '\n\n'
-        return sip_content
+                exten=asterisk_user.exten,
+                callerid='{} <{}>'.format(user_name, asterisk_user.exten)
+            ))
+            sip_content.append('\n\n')
+        return ''.join(sip_content)
+
+    def get_sip_peers_conf(self):
+        """SIP peers with their ETag, rendered again only when the server,
+        its channels or their users change.
+        Returns:
+            (etag, content) tuple.
+        """
+        self.ensure_one()
+        # Deletions change the count, edits change the write date.
+        self.env.cr.execute("""
+            SELECT (SELECT write_date FROM asterisk_plus_server WHERE id = %s),
+                   count(c.id), max(c.write_date), max(u.write_date),
+                   max(ru.write_date), max(p.write_date)
+            FROM asterisk_plus_user_channel c
+            JOIN asterisk_plus_user u ON u.id = c.asterisk_user
+            LEFT JOIN res_users ru ON ru.id = u."user"
+            LEFT JOIN res_partner p ON p.id = ru.partner_id
+            WHERE c.server = %s""", (self.id, self.id))
+        return self._get_rendered_config(
+            (self.id, 'sip_peers'), self.env.cr.fetchone(), self.get_sip_peers)
+
+    @api.model
+    def get_voicemail_conf(self):
+        """voicemail.conf snippet with its ETag, see get_sip_peers_conf.
+        """
+        self.env.cr.execute("""
+            SELECT count(u.id), max(u.write_date),
+                   max(ru.write_date), max(p.write_date)
+            FROM asterisk_plus_user u
+            LEFT JOIN res_users ru ON ru.id = u."user"
+            LEFT JOIN res_partner p ON p.id = ru.partner_id""")
+        return self._get_rendered_config(
+            (None, 'voicemail'), self.env.cr.fetchone(), self.generate_voicemail_conf)
+
+    @api.model
+    def _get_rendered_config(self, key, version, render):
+        key = (self.env.cr.dbname,) + key
+        etag = hashlib.md5(repr(version).encode()).hexdigest()
+        cached = rendered_configs.get(key)
+        if cached and cached[0] == etag:
+            return cached
+        res = (etag, render())
+        rendered_configs.set(key, res)
+        return res
 
     def _get_market_download_link(self):
         for rec in self:
@@ -256,46 +419,172 @@ class Server(models.Model):
             'target': 'current',
         }
 
+    @timed
     def local_job(self, fun, args=None, kwargs={}, timeout=6,
                   res_model=None, res_method=None, res_notify_uid=None,
                   res_notify_title='PBX', pass_back=None, 
-                  raise_exc=True):
+                  raise_exc=True, deferred=False):
+        """Call the Agent.
+        With deferred the job is put in the outbox and sent after commit,
+        so the caller does not wait for the Agent API.
+        """
         self.ensure_one()
-        res = {}
+        if deferred:
+            return self.env['asterisk_plus.outbox'].sudo().enqueue(
+                self, fun, args=args, kwargs=kwargs, timeout=timeout,
+                res_model=res_model, res_method=res_method,
+                res_notify_uid=res_notify_uid,
+                res_notify_title=res_notify_title, pass_back=pass_back)
         response = None
         # debug(self, 'Server job, args: {}, kwargs: {}, res: {}.{}, pass_back: {}'.format(
         #    args, kwargs, res_model, res_method, pass_back))
         try:
-            settings = self.env['asterisk_plus.settings'].sudo()
-            if not settings.get_param('is_subscribed'):
-                raise ValidationError('Asterisk Plus has no subscription!')
-            api_key = settings.get_param('api_key')
-            api_url = settings.get_param('api_url')
-            instance_uid = settings.get_param('instance_uid')
-            data = {
-                'fun': fun, 'args': args, 'kwargs': kwargs,
-                'res_model': res_model, 'res_method': res_method,
-                'res_notify_uid': res_notify_uid,
-                'res_notify_title': res_notify_title, 'pass_back': pass_back,
-            }
-            # debug(self, 'Sending API call to: %s' % api_url)
-            response = requests.post(
-                urljoin(api_url, 'app/asterisk_plus/agent'),
-                headers={
-                    'x-api-key': api_key,
-                    'x-instance-uid': instance_uid,
-                }, json=data, timeout=timeout, verify=False)
+            session, url, data = self._get_agent_request(
+                fun, args=args, kwargs=kwargs, res_model=res_model,
+                res_method=res_method, res_notify_uid=res_notify_uid,
+                res_notify_title=res_notify_title, pass_back=pass_back)
+            if self.sudo().agent_state != CLOSED:
+                metrics.inc('asterisk_plus_agent_breaker_rejected_total', fun=fun)
+                raise ValidationError('Agent API is unavailable, please try again later.')
+            # debug(self, 'Sending API call to: %s' % url)
+            try:
+                response = session.post(url, json=data, timeout=timeout)
+            except Exception as e:
+                if is_endpoint_failure(exc=e):
+                    self._record_agent_result(failures=1)
+                raise
+            self._record_agent_result(
+                failures=1 if is_endpoint_failure(response=response) else 0)
             response.raise_for_status()
             # debug(self, 'API response: %s' % response.text)
             return response
         except Exception as e:
+            metrics.inc('asterisk_plus_local_job_errors_total', fun=fun)
             if raise_exc:
                 if response is None:
                     raise ValidationError(str(e))
                 else:
                     raise ValidationError(response.text)
             else:
-                logger.exception('Local job error:')            
+                logger.exception('Local job error:')
+
+    def _get_agent_request(self, fun, args=None, kwargs={}, res_model=None,
+                           res_method=None, res_notify_uid=None,
+                           res_notify_title='PBX', pass_back=None):
+        """Session, URL and payload of an Agent job.
+        """
+        settings = self.env['asterisk_plus.settings'].sudo()
+        if not settings.get_param('is_subscribed'):
+            raise ValidationError('Asterisk Plus has no subscription!')
+        api_url = settings.get_param('api_url')
+        session = agent_session.get(
+            api_url, settings.get_param('api_key'),
+            settings.get_param('instance_uid'),
+            settings.get_param('agent_pool_size') or 10)
+        data = {
+            'fun': fun, 'args': args, 'kwargs': kwargs,
+            'res_model': res_model, 'res_method': res_method,
+            'res_notify_uid': res_notify_uid,
+            'res_notify_title': res_notify_title, 'pass_back': pass_back,
+        }
+        return session, urljoin(api_url, 'app/asterisk_plus/agent'), data            
+
+    def _record_agent_result(self, failures=0):
+        """Count Agent API endpoint failures of the server, 0 for a success.
+        The circuit opens after FAILURE_THRESHOLD failures in a row, for all
+        workers at once. Counted in a separate transaction, the calling one
+        may be rolled back.
+        """
+        self.ensure_one()
+        state, count = self.sudo().agent_state, self.sudo().agent_failures
+        if not failures and (state != CLOSED or not count):
+            # Nothing to reset, only the prober closes the circuit.
+            return
+        try:
+            with Registry(self.env.cr.dbname).cursor() as cr:
+                # Do not wait for a transaction that holds the server row.
+                cr.execute("""
+                    SELECT agent_state, agent_failures FROM asterisk_plus_server
+                    WHERE id = %s FOR UPDATE NOWAIT""", (self.id,))
+                state, count = cr.fetchone()
+                if state != CLOSED:
+                    return
+                count = count + failures if failures else 0
+                new_state = OPEN if count >= FAILURE_THRESHOLD else CLOSED
+                cr.execute("""
+                    UPDATE asterisk_plus_server SET agent_state = %s, agent_failures = %s,
+                        agent_opened_at = CASE WHEN %s THEN (now() at time zone 'UTC')
+                                          ELSE agent_opened_at END
+                    WHERE id = %s""", (new_state, count, new_state == OPEN, self.id))
+                if new_state == OPEN:
+                    logger.warning('Agent API of server %s is unavailable, failing fast '
+                                   'until the prober sees it back.', self.id)
+                    env = api.Environment(cr, SUPERUSER_ID, {})
+                    server = env['asterisk_plus.server'].browse(self.id)
+                    server._notify_agent_state(OPEN)
+                    server._trigger_probe()
+        except Exception as e:
+            logger.info('Agent API health of server %s not updated: %s', self.id, e)
+
+    @api.model
+    def _trigger_probe(self, delay=0):
+        trigger_cron(self.env, 'asterisk_plus.probe_agent',
+                     datetime.utcnow() + timedelta(seconds=delay))
+
+    def _notify_agent_state(self, state):
+        """Notify PBX admins about the Agent API circuit state."""
+        if state == CLOSED:
+            message, warning = 'Agent API of {} is available again.'.format(self.name), False
+        else:
+            message, warning = 'Agent API of {} is unavailable, Agent requests are paused.'.format(
+                self.name), True
+        settings = self.env['asterisk_plus.settings']
+        for user in self.env.ref('asterisk_plus.group_asterisk_admin').users:
+            settings.odoopbx_notify(message, notify_uid=user.id, sticky=warning,
+                                    warning=warning)
+
+    def _set_agent_state(self, state):
+        # SQL keeps write_date, it is a part of the sip_peers version.
+        self.env.cr.execute("""
+            UPDATE asterisk_plus_server SET agent_state = %s,
+                agent_failures = CASE WHEN %s THEN 0 ELSE agent_failures END
+            WHERE id IN %s""", (state, state == CLOSED, tuple(self.ids)))
+        if tools.odoo.release.version_info[0] >= 16:
+            self.invalidate_recordset(['agent_state', 'agent_failures'])
+        else:
+            self.invalidate_cache(['agent_state', 'agent_failures'], self.ids)
+
+    @api.model
+    def probe_agent(self):
+        """Probe the Agent API of servers with an open circuit, called by cron.
+        An advisory lock keeps a single prober for all workers.
+        """
+        cr = self.env.cr
+        cr.execute('SELECT pg_try_advisory_lock(%s, 0)', (PROBE_LOCK_NAMESPACE,))
+        if not cr.fetchone()[0]:
+            return
+        try:
+            for server in self.sudo().search([('agent_state', '!=', CLOSED)]):
+                server._set_agent_state(HALF_OPEN)
+                cr.commit()
+                try:
+                    session, url, data = server._get_agent_request('test.ping')
+                    response = session.post(url, json=data, timeout=5)
+                    error = '{} {}'.format(response.status_code, response.text) \
+                        if is_endpoint_failure(response=response) else None
+                except Exception as e:
+                    error = str(e)
+                if error:
+                    logger.info('Agent API probe of server %s failed: %s', server.id, error)
+                    server._set_agent_state(OPEN)
+                    server._trigger_probe(PROBE_INTERVAL)
+                else:
+                    logger.info('Agent API of server %s is available again.', server.id)
+                    server._set_agent_state(CLOSED)
+                    server._notify_agent_state(CLOSED)
+                cr.commit()
+        finally:
+            cr.execute('SELECT pg_advisory_unlock(%s, 0)', (PROBE_LOCK_NAMESPACE,))
 
     def ping_agent(self):
         self.ensure_one()
@@ -314,9 +603,35 @@ class Server(models.Model):
             raise ValidationError(str(e))
 
     def ami_action(self, action, timeout=5, no_wait=False, as_list=None, **kwargs):
+        """Send an AMI action or a list of actions in one Agent request.
+        For a list, pass_back may be a list of the same length, then every
+        action reply is sent to res_method with its own pass_back.
+        """
+        if not isinstance(action, list):
+            return self.local_job(
+                fun='asterisk.manager_action',
+                args=action,
+                kwargs={
+                    'as_list': as_list
+                }, **kwargs)
+        pass_back = kwargs.pop('pass_back', None)
+        if not isinstance(pass_back, list):
+            pass_back = [pass_back] * len(action)
+        if len(action) == 1 or not self.agent_batch_actions:
+            # Agents without asterisk.manager_actions get one request per action.
+            return [self.ami_action(item, timeout=timeout, as_list=as_list,
+                                    pass_back=item_pass_back, **kwargs)
+                    for item, item_pass_back in zip(action, pass_back)]
+        res_model = kwargs.pop('res_model', None)
+        res_method = kwargs.pop('res_method', None)
         return self.local_job(
-            fun='asterisk.manager_action',
-            args=action,
+            fun='asterisk.manager_actions',
+            args=[{
+                'action': item,
+                'res_model': res_model,
+                'res_method': res_method,
+                'pass_back': item_pass_back,
+            } for item, item_pass_back in zip(action, pass_back)],
             kwargs={
                 'as_list': as_list
             }, **kwargs)
@@ -363,6 +678,8 @@ class Server(models.Model):
         originate_timeout = float(self.env[
             'asterisk_plus.settings'].sudo().get_param('originate_timeout'))
 
+        # Originate actions by server, sent in one request per server.
+        actions = {}
         for asterisk_user in self.env.user.asterisk_users:
             if not asterisk_user.channels:
                 raise ValidationError('SIP channels not defined for user!')
@@ -422,8 +739,6 @@ class Server(models.Model):
                         'linkedid': other_channel_id,
                         'is_active': True,
                 })
-                if not self.env.context.get('no_commit'):
-                    self.env.cr.commit()
                 action = {
                     'Action': 'Originate',
                     'Context': ch.originate_context,
@@ -438,10 +753,16 @@ class Server(models.Model):
                     'OtherChannelId': other_channel_id,
                     'Variable': channel_vars,
                 }
-                ch.server.ami_action(action, res_model='asterisk_plus.server',
-                                     res_method='originate_call_response',
-                                     pass_back={'notify_uid': self.env.user.id,
-                                                'channel_id': channel_id})
+                server_actions = actions.setdefault(ch.server, ([], []))
+                server_actions[0].append(action)
+                server_actions[1].append({'notify_uid': self.env.user.id,
+                                          'channel_id': channel_id})
+        if not self.env.context.get('no_commit'):
+            self.env.cr.commit()
+        for server, (server_actions, pass_back) in actions.items():
+            server.ami_action(server_actions, res_model='asterisk_plus.server',
+                              res_method='originate_call_response',
+                              pass_back=pass_back)
 
     @api.model
     def originate_call_response(self, data, channel_id=None, notify_uid=None):
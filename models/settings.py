@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from collections import namedtuple
 from datetime import datetime
-import inspect
 import json
 import requests
 import logging
@@ -9,9 +9,11 @@ import re
 import sys
 from urllib.parse import urljoin
 import uuid
+import weakref
 from odoo import fields, models, api, tools, release, _
 from odoo.exceptions import ValidationError
 from odoo.tools import ormcache
+from .debug import debug_buffer
 
 logger = logging.getLogger(__name__)
 
@@ -26,24 +28,46 @@ PREPAID_PAYMENT_URL = 'https://buy.stripe.com/aEU01VaER5D15lC4gj'
 # Starting from Odoo 12.0 there is admin user with ID 2.
 ADMIN_USER_ID = 1 if release.version_info[0] <= 11 else 2
 
-
-def debug(rec, message, level='info'):
-    caller_module = inspect.stack()[1][3]
-    if level == 'info':
-        fun = logger.info
-    elif level == 'warning':
-        fun = logger.warning
-        fun('++++++ {}: {}'.format(caller_module, message))
+#: Worker local settings snapshots: dbname -> (version, snapshot).
+settings_snapshots = {}
+#: Cursors of transactions that changed settings, their snapshots are not
+#: shared as the transaction may be rolled back.
+settings_writers = weakref.WeakSet()
+#: Snapshot types by their field names.
+snapshot_types = {}
+
+
+def debug(rec, message, *args, level='info'):
+    """Trace a message of the caller.
+    Formatting is lazy: the message is %-formatted with args, or called with
+    args when it is a callable, only if the trace is enabled.
+    Info traces are enabled by debug_mode or, per module, by setting the
+    caller's logger to DEBUG (e.g. --log-handler=odoo.addons.asterisk_plus.models.channel:DEBUG).
+    Warnings and errors are always logged.
+    """
+    # Cheap caller lookup instead of inspect.stack() that reads sources.
+    frame = sys._getframe(1)
+    caller_logger = logging.getLogger(frame.f_globals.get('__name__', __name__))
+    debug_mode = rec.env['%s.settings' % MODULE_NAME].sudo().get_param('debug_mode')
+    if level == 'info' and not debug_mode and \
+            not caller_logger.isEnabledFor(logging.DEBUG):
+        return
+    caller_module = frame.f_code.co_name
+    if callable(message):
+        message = message(*args)
+    elif args:
+        message = message % args
+    if level == 'warning':
+        fun = caller_logger.warning
     elif level == 'error':
-        fun = logger.error
-        fun('++++++ {}: {}'.format(caller_module, message))
-    if rec.env['%s.settings' % MODULE_NAME].sudo().get_param('debug_mode'):
-        rec.env['%s.debug' % MODULE_NAME].sudo().create({
-            'model': str(rec),
-            'message': caller_module + ': ' + message,
-        })
-        if level == 'info':
-            fun('++++++ {}: {}'.format(caller_module, message))
+        fun = caller_logger.error
+    else:
+        fun = caller_logger.info
+    fun('++++++ %s: %s', caller_module, message)
+    if debug_mode:
+        # Written in bulk by the worker's debug writer, not in this transaction.
+        debug_buffer.append(rec.env.cr.dbname, rec.env.uid, str(rec),
+                            caller_module + ': ' + message)
 
 
 def strip_number(number):
@@ -96,10 +120,24 @@ class Settings(models.Model):
         default='from-internal', required=True,
         help='Default context to set when creating PBX / Odoo user mapping.')
     originate_timeout = fields.Integer(default=60, required=True)
+    agent_pool_size = fields.Integer(
+        string='Agent Connections', default=10, required=True,
+        help='Keep-alive connections to the agent API per Odoo worker.')
     # Search numbers by exact or partial match
     number_search_operation = fields.Selection(
-        [('=', 'Equal'), ('like', 'Like')],
-        default='=', required=True)
+        [('=', 'Equal'), ('like', 'Like'), ('suffix', 'Ends with')],
+        default='=', required=True,
+        help='Ends with: match numbers by their last digits using an index.')
+    unknown_number_cache_ttl = fields.Integer(
+        string='Unknown Number Cache TTL', default=300,
+        help='Seconds to remember numbers without a partner, 0 to disable.')
+    phone_normalize_progress = fields.Char(
+        compute='_get_phone_normalize_progress', string='Phone Normalization')
+    unknown_number_cache_size = fields.Integer(
+        string='Unknown Number Cache Size', default=10000,
+        help='Max unknown numbers remembered per worker, 0 to disable.')
+    # Bumped by SQL on settings changes, workers rebuild the settings snapshot.
+    settings_version = fields.Integer(readonly=True)
     disable_phone_format = fields.Boolean(help='Disable phone number format, e.g. +123456789 => +1 234 56 78')
     # Recording settings
     recordings_access = fields.Selection([('local', 'Local'),('remote', 'Remote')],
@@ -633,18 +671,42 @@ class Settings(models.Model):
 
     @api.model
     def create(self, vals):
-        if tools.odoo.release.version_info[0] >= 17:
-            self.env.registry.clear_cache()
-        else:
-            self.clear_caches()
-        return super(Settings, self).create(vals)
+        res = super(Settings, self).create(vals)
+        settings_writers.add(self.env.cr)
+        self._clear_settings_caches()
+        return res
 
     def write(self, vals):
+        res = super(Settings, self).write(vals)
+        settings_writers.add(self.env.cr)
+        # Sequence values are not rolled back, the version of a rolled back
+        # write is never used again.
+        self.env.cr.execute("""
+            UPDATE asterisk_plus_settings
+            SET settings_version = nextval('asterisk_plus_settings_version_seq')
+            WHERE id IN %s""", (tuple(self.ids),))
+        if tools.odoo.release.version_info[0] >= 16:
+            self.invalidate_recordset(['settings_version'])
+        else:
+            self.invalidate_cache(['settings_version'], self.ids)
+        # After the version is bumped, a snapshot built in between is stale.
+        self._clear_settings_caches()
+        return res
+
+    def init(self):
+        self.env.cr.execute(
+            'CREATE SEQUENCE IF NOT EXISTS asterisk_plus_settings_version_seq')
+        # Versions of older installations were counted in the table.
+        self.env.cr.execute("""
+            SELECT setval('asterisk_plus_settings_version_seq', GREATEST(
+                (SELECT last_value FROM asterisk_plus_settings_version_seq),
+                (SELECT COALESCE(max(settings_version), 0) + 1 FROM asterisk_plus_settings)))""")
+
+    def _clear_settings_caches(self):
         if tools.odoo.release.version_info[0] >= 17:
             self.env.registry.clear_cache()
         else:
             self.clear_caches()
-        return super(Settings, self).write(vals)
 
     def open_settings_form(self):
         rec = self.env['asterisk_plus.settings'].search([])
@@ -663,15 +725,67 @@ class Settings(models.Model):
         }
 
     @api.model
-    @ormcache('param')
-    def get_param(self, param, default=False):
-        """
-        """
+    def _get_settings_record(self):
         data = self.search([])
         if not data:
             data = self.sudo().with_context(no_constrains=True).create({})
         else:
             data = data[0]
+        return data
+
+    @api.model
+    @ormcache()
+    def _get_settings_version(self):
+        # Only settings create / write change it, the registry cache clear
+        # on other models just makes it read again with one cheap query.
+        self.env.cr.execute(
+            'SELECT id, settings_version FROM asterisk_plus_settings ORDER BY id LIMIT 1')
+        row = self.env.cr.fetchone()
+        if not row:
+            data = self._get_settings_record()
+            row = (data.id, data.settings_version)
+        return (row[0], row[1] or 0)
+
+    @api.model
+    def get_settings(self):
+        """Immutable snapshot of the stored non relational settings.
+        It is built once per settings version and shared in the worker.
+        Returns:
+            namedtuple with settings field values.
+        """
+        version = self._get_settings_version()
+        dbname = self.env.cr.dbname
+        shared = self.env.cr not in settings_writers
+        cached = settings_snapshots.get(dbname)
+        if shared and cached and cached[0] == version:
+            return cached[1]
+        names = tuple(sorted(
+            name for name, field in self._fields.items() if field.store and
+            not field.relational and name not in models.MAGIC_COLUMNS and
+            name != 'display_name'))
+        snapshot_type = snapshot_types.get(names)
+        if snapshot_type is None:
+            snapshot_type = snapshot_types[names] = namedtuple('SettingsSnapshot', names)
+        values = self._get_settings_record().sudo().read(list(names))[0]
+        snapshot = snapshot_type(**{name: values[name] for name in names})
+        if shared:
+            settings_snapshots[dbname] = (version, snapshot)
+        return snapshot
+
+    @api.model
+    def get_param(self, param, default=False):
+        """
+        """
+        snapshot = self.get_settings()
+        if param in snapshot._fields:
+            return getattr(snapshot, param)
+        # Computed and relational fields.
+        return self._get_computed_param(param, default)
+
+    @api.model
+    @ormcache('param')
+    def _get_computed_param(self, param, default=False):
+        data = self._get_settings_record()
         return getattr(data, param, default)
 
     @api.model
@@ -761,9 +875,10 @@ class Settings(models.Model):
         recording_event.is_enabled = True if self.record_calls is True else False
         # Reload events map
         servers = self.env['asterisk_plus.server'].search([])
-        for s in servers:
-            s.ami_action(
-                {'Action': 'ReloadEvents'},
+        if servers:
+            # All servers are reached through the same Agent API.
+            servers[0].ami_action(
+                [{'Action': 'ReloadEvents'} for s in servers], deferred=True,
             )
 
     @api.onchange('use_mp3_encoder')
@@ -775,6 +890,20 @@ class Settings(models.Model):
                 rec.mp3_encoder_bitrate = '96'
                 rec.mp3_encoder_quality = '4'
 
+    def _get_phone_normalize_progress(self):
+        progress = self.env['asterisk_plus.phone_normalize_chunk'].sudo().get_progress()
+        for rec in self:
+            if not progress['total']:
+                rec.phone_normalize_progress = _('Not started')
+            else:
+                rec.phone_normalize_progress = _(
+                    '{percent}% done, {partners} partners, {failed} failed chunks').format(**progress)
+
+    def normalize_partner_phones(self):
+        """Normalize phone numbers of all partners in background.
+        """
+        self.env['asterisk_plus.phone_normalize_chunk'].sudo().schedule()
+
     def sync_recording_storage(self):
         """Sync where call recordings are stored.
         """
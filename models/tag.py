@@ -25,6 +25,13 @@ class Tag(models.Model):
         return res
 
     def _get_recording_count(self):
+        # One grouped query for all records.
+        ids = [rec.id for rec in self if isinstance(rec.id, int)]
+        counts = {}
+        if ids:
+            for group in self.env['asterisk_plus.recording'].read_group(
+                    [('tags', 'in', ids)], ['tags'], ['tags']):
+                if group['tags']:
+                    counts[group['tags'][0]] = group['tags_count']
         for rec in self:
-            rec.recording_count = self.env['asterisk_plus.recording'].search_count(
-                    [('tags', 'in', rec.id)])
+            rec.recording_count = counts.get(rec.id, 0)
@@ -1,20 +1,30 @@
 import logging
-import re
 from odoo import models, fields, api, tools, release, SUPERUSER_ID, _
 from odoo.exceptions import ValidationError, UserError
 from passlib import pwd
 from random import choice
 from .server import get_default_server
 from .settings import debug
+from .cache import LRUCache
 
 logger = logging.getLogger(__name__)
 
+#: Worker local inbound routes: (dbname, server id, DID) -> (version, route).
+did_routes = LRUCache(maxsize=10000)
+
 
 #: Fields allowed to be changed by user.
 USER_PERMITTED_FIELDS = [
     'open_reference', 'missed_calls_notify', 'call_popup_is_enabled',
     'call_popup_is_sticky', 'dial_timeout', 'phone', 'mobile',
 ]
+#: PBX user fields used in DID routes.
+DID_ROUTE_FIELDS = {'user', 'server', 'dial_timeout'}
+
+
+def did_route_key(did):
+    """Number version key of the DID route, apart from unknown number keys."""
+    return 'did:' + did
 
 
 class PbxUser(models.Model):
@@ -71,6 +81,7 @@ class PbxUser(models.Model):
                 self.env.registry.clear_cache()
             else:
                 self.clear_caches()
+        self._evict_did_routes(pbx_user.sudo().mapped('user.phone_normalized'))
 
         if pbx_user.user and not pbx_user.user.has_group('asterisk_plus.group_asterisk_user'):
             group_asterisk_user = self.env.ref('asterisk_plus.group_asterisk_user')
@@ -87,15 +98,19 @@ class PbxUser(models.Model):
                 raise ValidationError(
                     _('Fields {} not allowed to be changed by user!').format(
                         ', '.join(restricted_fields)))
+        dids = self.sudo().mapped('user.phone_normalized') if set(vals) & DID_ROUTE_FIELDS else []
         user = super(PbxUser, self).write(vals)
         if user and not self.env.context.get('no_clear_cache'):
             if tools.odoo.release.version_info[0] >= 17:
                 self.env.registry.clear_cache()
             else:
                 self.clear_caches()
+        if dids:
+            self._evict_did_routes(dids + self.sudo().mapped('user.phone_normalized'))
         return user
 
     def unlink(self):
+        self._evict_did_routes(self.sudo().mapped('user.phone_normalized'))
         res = super(PbxUser, self).unlink()
         if res and not self.env.context.get('no_clear_cache'):
             if tools.odoo.release.version_info[0] >= 17:
@@ -202,11 +217,21 @@ class PbxUser(models.Model):
             next_extension += 1
 
     def _get_call_count(self):
+        # One grouped query for all records, a call is counted once even if
+        # the user both made and answered it.
+        user_ids = list(set(rec.user.id for rec in self if rec.user))
+        counts = {}
+        if user_ids:
+            self.env.cr.execute("""
+                SELECT u.id, count(*)
+                FROM res_users u
+                JOIN asterisk_plus_call c
+                    ON c.calling_user = u.id OR c.answered_user = u.id
+                WHERE u.id = ANY(%s)
+                GROUP BY u.id""", (user_ids,))
+            counts = dict(self.env.cr.fetchall())
         for rec in self:
-            rec.user_call_count = self.env[
-                'asterisk_plus.call'].sudo().search_count(
-                ['|', ('calling_user', '=', rec.user.id),
-                      ('answered_user', '=', rec.user.id)])
+            rec.user_call_count = counts.get(rec.user.id, 0)
 
     def action_view_calls(self):
         # Used from the user calls view button.
@@ -231,34 +256,75 @@ class PbxUser(models.Model):
         }
 
 
+    @api.model
+    def get_did_route(self, server_id, did):
+        """Inbound route of the user personal number on the server, None when
+        no user has it. Routes are cached per DID in every worker and checked
+        against the DID version, changes of users, PBX users and user channels
+        bump the versions of their numbers only.
+        Returns:
+            dict {'users', 'pbx_users', 'mobile', 'channels', 'dial_timeout'}.
+            The result is shared, do not change it.
+        """
+        # The version is read before the route so the route is not older.
+        version = self.env['asterisk_plus.number_version'].sudo().get_versions(
+            [did_route_key(did)])[did_route_key(did)]
+        key = (self.env.cr.dbname, server_id, did)
+        cached = did_routes.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        route = self._get_did_route(server_id, did)
+        did_routes.set(key, (version, route))
+        return route
+
+    @api.model
+    def _get_did_route(self, server_id, did):
+        users = self.env['res.users'].sudo().search([('phone_normalized', '=', did)])
+        if not users:
+            return None
+        pbx_users = self.sudo().search([('server', '=', server_id),
+                                        ('user', 'in', users.ids)])
+        channels = []
+        for pbx_user in pbx_users:
+            channels.extend(pbx_user.channels.mapped('name'))
+        debug(self, 'Built DID route of %s for server %s.', did, server_id)
+        return {
+            'users': len(users),
+            'pbx_users': len(pbx_users),
+            # Mobile is used only when the number belongs to one user.
+            'mobile': users.mobile_normalized if len(users) == 1 else False,
+            'channels': tuple(channels),
+            'dial_timeout': max(pbx_users.mapped('dial_timeout') or [0]),
+        }
+
+    @api.model
+    def _evict_did_routes(self, dids):
+        """Forget the routes of the DIDs in all workers. The key rows are
+        written in this transaction so other workers see them with the change.
+        """
+        keys = set(did_route_key(did) for did in dids if did)
+        if keys:
+            self.env['asterisk_plus.number_version'].sudo().bump(keys)
+
     @api.model
     def fagi_request(self, request):
         debug(self, 'AGI request: {}'.format(request))
         extension = request['agi_extension']
-        agi_channel = request['agi_channel']
-        channel = re.search('^(?P<channel>.+)-.+$', agi_channel).groupdict().get('channel')
-        callerid = request['agi_callerid']
+        server = self.env.user.asterisk_server or get_default_server(self)
         # Find destination users by personal number
-        users = self.env['asterisk_plus.user'].search(
-            [('phone_normalized', '=', extension)])
-        if len(users) == 1:
-            user = users[0]
-            debug(self, 'Found PBX user {} by phone {}'.format(user.name, extension))
-            channels = '&'.join([k.name for k in user.channels])
-            return [
-                'EXEC DIAL {},{},t'.format(channels, user.dial_timeout),
-            ]
-        elif len(users) > 1:
-            # Multiple users, no voicemail
-            channels = []
-            for user in users:
-                channels.extend(user.channels)
-            dial_channels = '&'.join([k.name for k in channels])
-            return [
-                'EXEC VERBOSE "Muliple users by number {} found."'.format(extension),
-                'EXEC DIAL {},{},t'.format(dial_channels,user.dial_timeout)
-            ]
-        else:
+        route = self.get_did_route(server.id, extension) if server else None
+        if not route or not route['pbx_users']:
             debug(self, 'No PBX user by number found.')
             return []
+        channels = '&'.join(route['channels'])
+        if route['pbx_users'] == 1:
+            debug(self, 'Found PBX user by phone {}'.format(extension))
+            return [
+                'EXEC DIAL {},{},t'.format(channels, route['dial_timeout']),
+            ]
+        # Multiple users, no voicemail
+        return [
+            'EXEC VERBOSE "Muliple users by number {} found."'.format(extension),
+            'EXEC DIAL {},{},t'.format(channels, route['dial_timeout'])
+        ]
 
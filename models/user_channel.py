@@ -78,9 +78,27 @@ class UserChannel(models.Model):
                 raise ValidationError(
                     _('Fields {} not allowed to be changed by user!').format(
                         ', '.join(restricted_fields)))
+        dids = self._get_route_dids() if set(values) & {'name', 'asterisk_user'} else []
         res = super(UserChannel, self).write(values)
+        if dids:
+            # DID routes keep channel names.
+            self.env['asterisk_plus.user']._evict_did_routes(dids + self._get_route_dids())
         return res
 
+    @api.model
+    def create(self, vals):
+        res = super(UserChannel, self).create(vals)
+        self.env['asterisk_plus.user']._evict_did_routes(res._get_route_dids())
+        return res
+
+    def unlink(self):
+        self.env['asterisk_plus.user']._evict_did_routes(self._get_route_dids())
+        res = super(UserChannel, self).unlink()
+        return res
+
+    def _get_route_dids(self):
+        return self.sudo().mapped('asterisk_user.user.phone_normalized')
+
     @api.depends('name')
     def _set_sip_user(self):
         for rec in self:
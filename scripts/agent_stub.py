@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+"""Local stand-in for the Agent API, for load testing without Asterisk.
+
+It answers the jobs that Server.local_job posts to app/asterisk_plus/agent
+and sends the results back to res_model.res_method over Odoo JSON-RPC,
+the same way the Agent does.
+
+Usage:
+    python3 scripts/agent_stub.py --port 8090 --odoo-url http://localhost:8069 \\
+        --db odoo --login asterisk1 --password asterisk1
+
+Then point the module at it: set api_url to http://localhost:8090/ and
+is_subscribed in Asterisk Plus settings. --latency and --error-rate help to
+exercise the outbox retries and the circuit breaker.
+"""
+import argparse
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import struct
+import threading
+import time
+import urllib.request
+import wave
+
+logger = logging.getLogger('agent_stub')
+
+AGENT_PATH = '/app/asterisk_plus/agent'
+
+
+def make_wav(seconds=1, rate=8000):
+    """Silent mono 16 bit WAV used as a call recording."""
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(struct.pack('<h', 0) * rate * seconds)
+    return buf.getvalue()
+
+
+class OdooClient(object):
+    """Minimal JSON-RPC client for the Agent callbacks."""
+
+    def __init__(self, url, db, login, password):
+        self.url = url.rstrip('/') + '/jsonrpc'
+        self.db = db
+        self.login = login
+        self.password = password
+        self.uid = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def call(self, service, method, *args):
+        data = json.dumps({
+            'jsonrpc': '2.0', 'method': 'call', 'id': next(self._ids),
+            'params': {'service': service, 'method': method, 'args': args},
+        }).encode()
+        request = urllib.request.Request(
+            self.url, data, {'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=60) as response:
+            reply = json.loads(response.read())
+        if reply.get('error'):
+            raise Exception(reply['error'].get('data', {}).get('message')
+                            or reply['error'].get('message'))
+        return reply['result']
+
+    def execute(self, model, method, args, kwargs=None):
+        with self._lock:
+            if self.uid is None:
+                self.uid = self.call('common', 'login', self.db, self.login, self.password)
+                if not self.uid:
+                    raise Exception('Odoo login failed for {}'.format(self.login))
+        return self.call('object', 'execute_kw', self.db, self.uid, self.password,
+                         model, method, args, kwargs or {})
+
+
+class AgentStub(object):
+    """Job handlers returning what the Agent would return."""
+
+    def __init__(self, odoo, latency=0.0, error_rate=0.0, ami_error_rate=0.0,
+                 workers=8):
+        self.odoo = odoo
+        self.latency = latency
+        self.error_rate = error_rate
+        self.ami_error_rate = ami_error_rate
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.recording = base64.b64encode(make_wav()).decode()
+        self.stats = {'jobs': 0, 'callbacks': 0, 'callback_errors': 0, 'rejected': 0}
+        self._lock = threading.Lock()
+
+    def count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def manager_action(self, action):
+        name = action.get('Action', '')
+        if random.random() < self.ami_error_rate:
+            return {'Response': 'Error', 'Message': 'Simulated AMI error'}
+        if name == 'Ping':
+            return {'Response': 'Success', 'Ping': 'Pong', 'Timestamp': str(time.time())}
+        if name == 'Originate':
+            return [{'Response': 'Success', 'Message': 'Originate successfully queued'}]
+        if name == 'CoreStatus':
+            return {'Response': 'Success', 'CoreCurrentCalls': '0',
+                    'CoreStartupTime': time.strftime('%H:%M:%S')}
+        return {'Response': 'Success', 'Message': '{} simulated'.format(name)}
+
+    def get_file(self, file_path, **kwargs):
+        file_name = os.path.basename(file_path)
+        if kwargs.get('file_format') == 'mp3':
+            file_name = os.path.splitext(file_name)[0] + '.mp3'
+        return {'file_data': self.recording, 'file_name': file_name}
+
+    def handle(self, job):
+        """Run the job and send the results back, returns callbacks."""
+        fun = job.get('fun')
+        args = job.get('args')
+        kwargs = job.get('kwargs') or {}
+        if fun == 'asterisk.manager_actions':
+            # One reply per action, each with its own callback.
+            return [(self.manager_action(item['action']), item.get('res_model'),
+                     item.get('res_method'), item.get('pass_back'))
+                    for item in args]
+        if fun == 'asterisk.manager_action':
+            result = self.manager_action(args)
+        elif fun == 'recording.get_file':
+            result = self.get_file(args, **kwargs)
+        elif fun == 'file.delete':
+            result = True
+        elif fun == 'test.ping':
+            result = 'pong'
+        else:
+            result = 'Agent stub: {} is not simulated'.format(fun)
+        return [(result, job.get('res_model'), job.get('res_method'), job.get('pass_back'))]
+
+    def process(self, job):
+        if self.latency:
+            time.sleep(self.latency)
+        for result, res_model, res_method, pass_back in self.handle(job):
+            try:
+                if res_model and res_method:
+                    self.odoo.execute(res_model, res_method, [result], pass_back or {})
+                elif job.get('res_notify_uid'):
+                    self.odoo.execute(
+                        'asterisk_plus.settings', 'odoopbx_notify', [str(result)],
+                        {'notify_uid': job['res_notify_uid'],
+                         'title': job.get('res_notify_title') or 'PBX'})
+                else:
+                    continue
+                self.count('callbacks')
+            except Exception as e:
+                self.count('callback_errors')
+                logger.error('%s callback %s.%s error: %s',
+                             job.get('fun'), res_model, res_method, e)
+
+
+def make_handler(stub):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                return self._reply(200, stub.stats)
+            self._reply(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length)
+            if self.path.rstrip('/') != AGENT_PATH:
+                return self._reply(404, {'error': 'Not found'})
+            if random.random() < stub.error_rate:
+                stub.count('rejected')
+                return self._reply(503, {'error': 'Simulated outage'})
+            try:
+                job = json.loads(body)
+            except ValueError:
+                return self._reply(400, {'error': 'Bad JSON'})
+            stub.count('jobs')
+            logger.debug('Job %s', job)
+            # The Agent replies at once and calls back when the job is done.
+            stub.executor.submit(stub.process, job)
+            self._reply(200, {'status': 'ok'})
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--odoo-url', default='http://localhost:8069')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--login', required=True, help='Login of the server user.')
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds before a job is answered.')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of requests rejected with 503.')
+    parser.add_argument('--ami-error-rate', type=float, default=0.0,
+                        help='Share of AMI actions answered with Response: Error.')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Concurrent callbacks to Odoo.')
+    parser.add_argument('--debug', action='store_true')
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    stub = AgentStub(OdooClient(options.odoo_url, options.db, options.login, options.password),
+                     latency=options.latency, error_rate=options.error_rate,
+                     ami_error_rate=options.ami_error_rate, workers=options.workers)
+    server = ThreadingHTTPServer((options.host, options.port), make_handler(stub))
+    logger.info('Agent stub listening on http://%s:%s%s', options.host, options.port, AGENT_PATH)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stub.executor.shutdown(wait=True)
+        logger.info('Stats: %s', stub.stats)
+
+
+if __name__ == '__main__':
+    main()
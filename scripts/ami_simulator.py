@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+"""AMI event generator for load testing the asterisk_plus.event handlers.
+
+It plays call scenarios as Newchannel / Newstate / VarSet / Hangup events and
+sends them over Odoo JSON-RPC as the server user, like the Agent does.
+
+Scenarios:
+    inbound   trunk call to a DID answered by an extension
+    outbound  extension calls an external number over the trunk
+    transfer  inbound call answered by one extension and transferred to another
+    queue     inbound call ringing all queue members, one of them answers
+
+Usage:
+    python3 scripts/ami_simulator.py --odoo-url http://localhost:8069 \\
+        --db odoo --login asterisk1 --password asterisk1 \\
+        --scenario inbound,outbound,queue --rate 5 --calls 500 --batch 10
+
+With --batch 0 every event is sent to its handler separately, otherwise
+events are sent to asterisk_plus.channel.on_ami_events in batches.
+Extensions must have PJSIP/<exten> user channels on the server.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import urllib.request
+
+logger = logging.getLogger('ami_simulator')
+
+#: Handler of every event in --batch 0 mode, as in data/events.xml.
+HANDLERS = {
+    'Newchannel': ('asterisk_plus.channel', 'on_ami_new_channel'),
+    'Newstate': ('asterisk_plus.channel', 'on_ami_update_channel_state'),
+    'Hangup': ('asterisk_plus.channel', 'on_ami_hangup'),
+    'VarSet': ('asterisk_plus.channel', 'update_recording_filename'),
+}
+
+STATES = {'0': 'Down', '4': 'Ring', '5': 'Ringing', '6': 'Up'}
+
+
+class OdooClient(object):
+    """Minimal JSON-RPC client, one per sending thread."""
+
+    def __init__(self, url, db, login, password):
+        self.url = url.rstrip('/') + '/jsonrpc'
+        self.db = db
+        self.login = login
+        self.password = password
+        self.uid = None
+        self._ids = itertools.count(1)
+
+    def call(self, service, method, *args):
+        data = json.dumps({
+            'jsonrpc': '2.0', 'method': 'call', 'id': next(self._ids),
+            'params': {'service': service, 'method': method, 'args': args},
+        }).encode()
+        request = urllib.request.Request(
+            self.url, data, {'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=60) as response:
+            reply = json.loads(response.read())
+        if reply.get('error'):
+            raise Exception(reply['error'].get('data', {}).get('message')
+                            or reply['error'].get('message'))
+        return reply['result']
+
+    def execute(self, model, method, *args):
+        if self.uid is None:
+            self.uid = self.call('common', 'login', self.db, self.login, self.password)
+            if not self.uid:
+                raise Exception('Odoo login failed for {}'.format(self.login))
+        return self.call('object', 'execute_kw', self.db, self.uid, self.password,
+                         model, method, list(args))
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.events = 0
+        self.requests = 0
+        self.errors = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def add(self, events, latency, error=False):
+        with self._lock:
+            self.events += events
+            self.requests += 1
+            self.latencies.append(latency)
+            if error:
+                self.errors += 1
+
+    def call_done(self):
+        with self._lock:
+            self.calls += 1
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies) or [0]
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return ('{} calls, {} events, {} requests, {} errors in {:.1f}s, '
+                '{:.1f} events/s, latency p50 {:.3f}s p95 {:.3f}s p99 {:.3f}s max {:.3f}s').format(
+            self.calls, self.events, self.requests, self.errors, elapsed,
+            self.events / elapsed if elapsed else 0,
+            percentile(0.5), percentile(0.95), percentile(0.99), latencies[-1])
+
+
+class Call(object):
+    """Builds the AMI events of one call."""
+    _sequence = itertools.count(1)
+    _sequence_lock = threading.Lock()
+
+    def __init__(self, system_name='asterisk', trunk='PJSIP/trunk'):
+        self.system_name = system_name
+        self.trunk = trunk
+        self.base = '{:.0f}.{}'.format(time.time(), random.randint(0, 10 ** 6))
+        self._channels = itertools.count(1)
+        self.linkedid = None
+
+    def channel(self, name, callerid_num, exten, context='from-internal',
+                connected_num='', linkedid=None):
+        uniqueid = '{}.{}'.format(self.base, next(self._channels))
+        if linkedid is None and self.linkedid is None:
+            self.linkedid = uniqueid
+        return {
+            'Channel': '{}-{:08x}'.format(name, random.randint(0, 0xffffffff)),
+            'Uniqueid': uniqueid,
+            'Linkedid': linkedid or self.linkedid,
+            'CallerIDNum': callerid_num,
+            'CallerIDName': '',
+            'ConnectedLineNum': connected_num,
+            'ConnectedLineName': '',
+            'Exten': exten,
+            'Context': context,
+        }
+
+    def event(self, name, channel, state='0', **extra):
+        with self._sequence_lock:
+            sequence = next(self._sequence)
+        now = time.time()
+        event = {
+            'Event': name,
+            'Privilege': 'call,all',
+            'SystemName': self.system_name,
+            'ChannelState': state,
+            'ChannelStateDesc': STATES[state],
+            'Language': 'en',
+            'AccountCode': '',
+            'Priority': '1',
+            'SequenceNumber': str(sequence),
+            'Timestamp': '{:.6f}'.format(now),
+            'EventTime': now,
+        }
+        event.update(channel)
+        event.update(extra)
+        return event
+
+    def new(self, channel, state='0'):
+        return self.event('Newchannel', channel, state)
+
+    def up(self, channel):
+        return self.event('Newstate', channel, '6')
+
+    def recording(self, channel):
+        return self.event('VarSet', channel, '6', Variable='MIXMONITOR_FILENAME',
+                          Value='/var/spool/asterisk/monitor/{}.wav'.format(channel['Uniqueid']))
+
+    def hangup(self, channel, cause='16', cause_txt='Normal Clearing', state='6'):
+        return self.event('Hangup', channel, state, Cause=cause, **{'Cause-txt': cause_txt})
+
+
+def external_number():
+    return '+1{}'.format(random.randint(2000000000, 9999999999))
+
+
+def inbound(options):
+    """Yields (delay, events) steps of the call."""
+    call = Call(trunk=options.trunk)
+    exten = random.choice(options.extensions)
+    caller = external_number()
+    trunk = call.channel(options.trunk, caller, options.did, context='from-trunk')
+    agent = call.channel('PJSIP/{}'.format(exten), exten, options.did, connected_num=caller)
+    yield 0, [call.new(trunk, '4'), call.new(agent, '5')]
+    yield options.ring_time, [call.up(agent), call.up(trunk), call.recording(trunk)]
+    yield options.talk_time, [call.hangup(agent), call.hangup(trunk)]
+
+
+def outbound(options):
+    call = Call(trunk=options.trunk)
+    exten = random.choice(options.extensions)
+    number = external_number()
+    agent = call.channel('PJSIP/{}'.format(exten), exten, number)
+    trunk = call.channel(options.trunk, exten, number, context='from-internal',
+                         connected_num=exten)
+    yield 0, [call.new(agent, '4'), call.new(trunk, '0')]
+    yield options.ring_time, [call.up(trunk), call.up(agent), call.recording(agent)]
+    yield options.talk_time, [call.hangup(trunk), call.hangup(agent)]
+
+
+def transfer(options):
+    call = Call(trunk=options.trunk)
+    first, second = random.sample(options.extensions, 2)
+    caller = external_number()
+    trunk = call.channel(options.trunk, caller, options.did, context='from-trunk')
+    agent = call.channel('PJSIP/{}'.format(first), first, options.did, connected_num=caller)
+    yield 0, [call.new(trunk, '4'), call.new(agent, '5')]
+    yield options.ring_time, [call.up(agent), call.up(trunk), call.recording(trunk)]
+    # Blind transfer: the first agent leaves, the second one rings.
+    target = call.channel('PJSIP/{}'.format(second), second, options.did, connected_num=caller)
+    yield options.talk_time / 2, [call.hangup(agent), call.new(target, '5')]
+    yield options.ring_time, [call.up(target)]
+    yield options.talk_time / 2, [call.hangup(target), call.hangup(trunk)]
+
+
+def queue(options):
+    call = Call(trunk=options.trunk)
+    caller = external_number()
+    trunk = call.channel(options.trunk, caller, options.did, context='from-trunk')
+    members = [call.channel('PJSIP/{}'.format(exten), exten, options.did, connected_num=caller)
+               for exten in options.extensions]
+    # Local channels of the queue members, skipped by the handler conditions.
+    local = [call.channel('Local/{}@from-queue'.format(exten), caller, exten,
+                          context='from-queue') for exten in options.extensions]
+    yield 0, [call.new(trunk, '4')]
+    yield options.queue_wait, [call.new(ch) for ch in local] + [call.new(ch, '5') for ch in members]
+    answered = random.choice(members)
+    events = [call.up(answered), call.up(trunk), call.recording(trunk)]
+    events += [call.hangup(ch, cause='26', cause_txt='Answered elsewhere', state='5')
+               for ch in members if ch is not answered]
+    events += [call.hangup(ch, cause='26', cause_txt='Answered elsewhere', state='0')
+               for ch in local]
+    yield options.ring_time, events
+    yield options.talk_time, [call.hangup(answered), call.hangup(trunk)]
+
+
+SCENARIOS = {
+    'inbound': inbound,
+    'outbound': outbound,
+    'transfer': transfer,
+    'queue': queue,
+}
+
+
+class Sender(object):
+    """Sends events one by one or in batches, one Odoo client per thread."""
+
+    def __init__(self, options, stats):
+        self.options = options
+        self.stats = stats
+        self._local = threading.local()
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = OdooClient(
+                self.options.odoo_url, self.options.db,
+                self.options.login, self.options.password)
+        return client
+
+    def send(self, events):
+        if self.options.batch:
+            with self._lock:
+                self._buffer.extend(events)
+                if len(self._buffer) < self.options.batch:
+                    return
+                events, self._buffer = self._buffer, []
+            self._send_batch(events)
+            return
+        for event in events:
+            if event['Channel'].startswith('Local/'):
+                # Filtered out by the event conditions.
+                continue
+            model, method = HANDLERS[event['Event']]
+            self._request(1, model, method, event)
+
+    def flush(self):
+        with self._lock:
+            events, self._buffer = self._buffer, []
+        if events:
+            self._send_batch(events)
+
+    def _send_batch(self, events):
+        self._request(len(events), 'asterisk_plus.channel', 'on_ami_events', events)
+
+    def _request(self, count, model, method, *args):
+        start = time.monotonic()
+        error = False
+        try:
+            res = self.client.execute(model, method, *args)
+            logger.debug('%s.%s: %s', model, method, res)
+        except Exception as e:
+            error = True
+            logger.error('%s.%s error: %s', model, method, e)
+        self.stats.add(count, time.monotonic() - start, error)
+
+
+def play(scenario, options, sender, stats):
+    try:
+        for delay, events in scenario(options):
+            if delay:
+                time.sleep(delay)
+            sender.send(events)
+    except Exception:
+        logger.exception('%s call error:', scenario.__name__)
+    stats.call_done()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--odoo-url', default='http://localhost:8069')
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--login', required=True, help='Login of the server user.')
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--scenario', default='inbound',
+                        help='Comma separated: {}.'.format(', '.join(sorted(SCENARIOS))))
+    parser.add_argument('--rate', type=float, default=1.0, help='New calls per second.')
+    parser.add_argument('--calls', type=int, default=10, help='Calls to play.')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='Max calls in progress.')
+    parser.add_argument('--batch', type=int, default=0,
+                        help='Events per on_ami_events request, 0 to call handlers one by one.')
+    parser.add_argument('--extensions', default='101,102,103',
+                        help='Comma separated extensions with PJSIP/<exten> channels.')
+    parser.add_argument('--trunk', default='PJSIP/trunk')
+    parser.add_argument('--did', default='+15550100')
+    parser.add_argument('--ring-time', type=float, default=2.0)
+    parser.add_argument('--talk-time', type=float, default=10.0)
+    parser.add_argument('--queue-wait', type=float, default=1.0)
+    parser.add_argument('--debug', action='store_true')
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    options.extensions = [e.strip() for e in options.extensions.split(',') if e.strip()]
+    scenarios = [SCENARIOS[name.strip()] for name in options.scenario.split(',')]
+    if transfer in scenarios and len(options.extensions) < 2:
+        parser.error('transfer scenario needs at least 2 extensions.')
+
+    stats = Stats()
+    sender = Sender(options, stats)
+    started = time.monotonic()
+    interval = 1.0 / options.rate if options.rate > 0 else 0
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        for i in range(options.calls):
+            # Keep the call rate steady whatever the previous calls take.
+            wait = started + i * interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            executor.submit(play, scenarios[i % len(scenarios)], options, sender, stats)
+    sender.flush()
+    logger.info(stats.report(time.monotonic() - started))
+    return 1 if stats.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())